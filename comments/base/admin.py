@@ -1,6 +1,32 @@
 from django.contrib import admin
-from .models import UserProfile, BlogPost, Subscription
+from django.contrib.postgres.search import SearchQuery
+from .models import UserProfile, BlogPost, Subscription, Comment
 
 admin.site.register(UserProfile)
 admin.site.register(BlogPost)
 admin.site.register(Subscription)
+
+
+@admin.register(Comment)
+class CommentAdmin(admin.ModelAdmin):
+    list_display = ('id', '__str__', 'author', 'created_at', 'root_type', 'root_id')
+    list_select_related = ('author',)
+    raw_id_fields = ('author',)
+    readonly_fields = ('root_type', 'root_id', 'children_count', 'descendants_count')
+    exclude = ('descendants',)
+    show_full_result_count = False
+
+    def get_readonly_fields(self, request, obj=None):
+        # Дерево строится только при вставке, смена родителя - через перенос (CommentManager.move_subtree)
+        if obj is not None:
+            return self.readonly_fields + ('parent_type', 'parent_id')
+        return self.readonly_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        # Поиск по полнотекстовому индексу вместо icontains по всей таблице
+        if not search_term:
+            return queryset, False
+        return queryset.filter(search_vector=SearchQuery(search_term, config=Comment.SEARCH_CONFIG)), False
+
+    def get_search_fields(self, request):
+        return ('text',)
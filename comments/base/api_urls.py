@@ -1,14 +1,21 @@
 from django.conf.urls import url
 from .views import (
-    CommentListView, CommentDetailView, CommentDescendantsView, UserCommentListView,
-    CommentListAsFileView, CommentLogView
+    CommentListView, CommentBatchListView, CommentDetailView, CommentDescendantsView, UserCommentListView,
+    CommentListAsFileView, CommentLogView, CommentBulkCreateView, CommentSearchView, CommentMoveView,
+    CommentSubtreeView, comment_stream_view
 )
 
 urlpatterns = [
-    url(r'^comments/$', CommentListView.as_view()),
+    url(r'^comments/$', CommentListView.as_view(), name='comment-list'),
+    url(r'^comments/bulk/$', CommentBulkCreateView.as_view()),
+    url(r'^comments/batch/$', CommentBatchListView.as_view()),
     url(r'^comments/(?P<pk>\d+)/$', CommentDetailView.as_view()),
     url(r'^comments/(?P<pk>\d+)/log/$', CommentLogView.as_view()),
+    url(r'^comments/(?P<pk>\d+)/move/$', CommentMoveView.as_view()),
+    url(r'^comments/(?P<pk>\d+)/subtree/$', CommentSubtreeView.as_view()),
     url(r'^comments-descendants/$', CommentDescendantsView.as_view()),
+    url(r'^comments-search/$', CommentSearchView.as_view()),
     url(r'^user-comments/(?P<user_id>\d+)/$', UserCommentListView.as_view()),
-    url(r'^comments-as-file/$', CommentListAsFileView.as_view())
+    url(r'^comments-as-file/$', CommentListAsFileView.as_view()),
+    url(r'^comments-stream/$', comment_stream_view)
 ]
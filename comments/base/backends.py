@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class BaseEventBackend(object):
+    """Доставка событий о комментариях подписчикам"""
+
+    def send(self, subscription, data):
+        self.send_many([subscription], data)
+
+    def send_many(self, subscriptions, data):
+        raise NotImplementedError
+
+
+class ConsoleEventBackend(BaseEventBackend):
+    def send_many(self, subscriptions, data):
+        for subscription in subscriptions:
+            print(subscription.user_id, data)
+
+
+def get_event_backend():
+    return import_string(settings.COMMENTS_EVENT_BACKEND)()
@@ -0,0 +1,344 @@
+import itertools
+import os
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import signals
+from django.db import connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+
+from .models import BlogPost, Comment, CommentsAsFileTask
+from .postgresql.base import close_pool
+from .seeding import build_forest
+
+
+class Rollback(Exception):
+    pass
+
+
+def summarize(timings, queries=None):
+    """Статистика по замерам в миллисекундах"""
+    timings = sorted(t * 1000 for t in timings)
+    stats = {
+        'runs': len(timings),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0], 3),
+        'max_ms': round(timings[-1], 3),
+    }
+    if queries is not None:
+        stats['queries'] = queries
+    return stats
+
+
+def measure(func, repeat, setup=None):
+    """
+    Замер func repeat раз. Перед каждым запуском вызывается setup (не входит в замер),
+    его результат передается в func как аргументы. Первый запуск - прогрев, в нем считаются запросы к базе
+    """
+    args = setup() if setup else ()
+    # Лог запросов ограничен по длине: заполненный предыдущими замерами он перестает расти
+    connection.queries_log.clear()
+    with CaptureQueriesContext(connection) as queries:
+        func(*args)
+    timings = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return summarize(timings, len(queries))
+
+
+def run_in_rollback(func, *args, **kwargs):
+    """Выполняет замер в транзакции, которая затем откатывается: база остается чистой"""
+    result = None
+    try:
+        with transaction.atomic():
+            result = func(*args, **kwargs)
+            raise Rollback
+    except Rollback:
+        pass
+    return result
+
+
+def build_chain(author, entity, depth):
+    """Цепочка из depth вложенных комментариев, возвращает список от корня к листу"""
+    comment_type = ContentType.objects.get_for_model(Comment)
+    entity_type = ContentType.objects.get_for_model(entity)
+    chain = [Comment.objects.create(author=author, text='0', parent_type=entity_type, parent_id=entity.id)]
+    for level in range(1, depth):
+        chain.append(Comment.objects.create(
+            author=author, text=str(level), parent_type=comment_type, parent_id=chain[-1].id
+        ))
+    return chain
+
+
+def build_thread(size, depth, shape):
+    """Одна ветка заданной формы, возвращает сущность и первый комментарий ветки"""
+    post, = build_forest(entities=1, threads=1, size=size, depth=depth, shape=shape, authors=5, seed=0)
+    entity_type = ContentType.objects.get_for_model(BlogPost)
+    return post, Comment.objects.get_children((post.id, entity_type.id)).get()
+
+
+def bench_insert(depths=(1, 10, 100), repeat=200):
+    """Время вставки ответа (комментарий + связи closure table) на разной глубине ветки"""
+    def run():
+        author = get_user_model().objects.create(username=f'benchmark-{time.time()}')
+        chain = build_chain(author, BlogPost.objects.create(), max(depths))
+        comment_type = ContentType.objects.get_for_model(Comment)
+        results = {}
+        for depth in depths:
+            parent = chain[depth - 1]
+            results[f'depth_{depth}'] = measure(
+                lambda: Comment.objects.create(
+                    author=author, text='reply', parent_type=comment_type, parent_id=parent.id
+                ),
+                repeat
+            )
+        return results
+    return run_in_rollback(run)
+
+
+def bench_delete(depths=(1, 10, 100), repeat=200):
+    """Время удаления листа (счетчики предков + связи closure table) на разной глубине ветки"""
+    def run():
+        author = get_user_model().objects.create(username=f'benchmark-{time.time()}')
+        chain = build_chain(author, BlogPost.objects.create(), max(depths))
+        comment_type = ContentType.objects.get_for_model(Comment)
+        results = {}
+        for depth in depths:
+            parent = chain[depth - 1]
+            results[f'depth_{depth}'] = measure(
+                lambda reply: reply.delete(),
+                repeat,
+                setup=lambda: (Comment.objects.create(
+                    author=author, text='reply', parent_type=comment_type, parent_id=parent.id
+                ),)
+            )
+        return results
+    return run_in_rollback(run)
+
+
+def bench_delete_subtree(sizes=(100, 10000), repeat=200):
+    """
+    Удаление ветки целиком (число повторов до 10): по одному комментарию от листьев (только 100),
+    одним delete_subtree и мягкое удаление надгробиями
+    """
+    def run():
+        results = {}
+        repeat_subtree = min(repeat, 10)
+        for size in sizes:
+            def setup():
+                return build_thread(size, 10, 'random')[1],
+            if size <= 100:
+                results[f'per_object_{size}'] = measure(
+                    lambda root: [
+                        comment.delete()
+                        for comment in Comment.objects.filter(ancestor_links__from_comment_id=root.id).order_by('-id')
+                    ],
+                    repeat_subtree, setup=setup
+                )
+            results[f'hard_{size}'] = measure(
+                lambda root: Comment.objects.delete_subtree(root), repeat_subtree, setup=setup
+            )
+            results[f'soft_{size}'] = measure(
+                lambda root: Comment.objects.delete_subtree(root, soft=True), repeat_subtree, setup=setup
+            )
+        return results
+    return run_in_rollback(run)
+
+
+def bench_root(depths=(1, 10, 100), repeat=200):
+    """Поиск корневого комментария ветки по closure table"""
+    def run():
+        author = get_user_model().objects.create(username=f'benchmark-{time.time()}')
+        chain = build_chain(author, BlogPost.objects.create(), max(depths))
+        return {
+            f'depth_{depth}': measure(chain[depth - 1].get_root, repeat)
+            for depth in depths
+        }
+    return run_in_rollback(run)
+
+
+def bench_children(sizes=(10, 1000), repeat=200):
+    """Прямые ответы на комментарий в широкой ветке"""
+    def run():
+        comment_type = ContentType.objects.get_for_model(Comment)
+        results = {}
+        for size in sizes:
+            _, root = build_thread(size + 1, 2, 'wide')
+            results[f'wide_{size}'] = measure(
+                lambda: list(Comment.objects.get_children((root.id, comment_type.id))), repeat
+            )
+        return results
+    return run_in_rollback(run)
+
+
+def bench_batch(entities=50, limit=5, repeat=200):
+    """Страница ленты: первые limit комментариев и их число у каждой из entities сущностей"""
+    def run():
+        posts = build_forest(entities=entities, threads=20, size=1, depth=1, shape='wide', authors=5, seed=0)
+        entity_type = ContentType.objects.get_for_model(BlogPost)
+        parents = [(post.id, entity_type.id) for post in posts]
+
+        def per_parent():
+            for parent in parents:
+                children = Comment.objects.get_children(parent)
+                list(children.order_by('-created_at', '-id')[:limit])
+                children.count()
+        return {
+            f'per_parent_{entities}': measure(per_parent, repeat),
+            f'batch_{entities}': measure(lambda: Comment.objects.get_children_batch(parents, limit), repeat),
+        }
+    return run_in_rollback(run)
+
+
+def bench_descendants(repeat=200):
+    """Все потомки первого комментария ветки: плоским списком и деревом"""
+    cases = {
+        'wide_1000': (1000, 2, 'wide'),
+        'deep_100': (100, 100, 'deep'),
+        'random_1000': (1000, 10, 'random'),
+    }
+
+    def run():
+        comment_type = ContentType.objects.get_for_model(Comment)
+        results = {}
+        for name, (size, depth, shape) in cases.items():
+            _, root = build_thread(size, depth, shape)
+            parent = (root.id, comment_type.id)
+            results[name] = measure(lambda: list(Comment.objects.get_descendants(parent)), repeat)
+            results[f'{name}_tree'] = measure(lambda: Comment.objects.get_thread(parent), repeat)
+        return results
+    return run_in_rollback(run)
+
+
+def bench_move(sizes=(100, 10000), repeat=200):
+    """
+    Перенос ветки целиком (первый комментарий со всеми потомками, число повторов до 20):
+    попеременно под комментарий глубины 10 другой сущности и обратно к исходной сущности
+    """
+    def run():
+        comment_type = ContentType.objects.get_for_model(Comment)
+        entity_type = ContentType.objects.get_for_model(BlogPost)
+        author = get_user_model().objects.create(username=f'benchmark-{time.time()}')
+        target = build_chain(author, BlogPost.objects.create(), 10)[-1]
+        results = {}
+        for size in sizes:
+            post, root = build_thread(size, 10, 'random')
+            parents = itertools.cycle([(target.id, comment_type.id), (post.id, entity_type.id)])
+            results[f'random_{size}'] = measure(
+                lambda parent: Comment.objects.move_subtree(root, parent),
+                min(repeat, 20),
+                setup=lambda: (next(parents),)
+            )
+        return results
+    return run_in_rollback(run)
+
+
+def bench_export(size=5000, repeat=200):
+    """
+    Выгрузка всех комментариев сущности в файл (задача celery без очереди) во всех форматах, без сжатия
+    и с gzip, число повторов до 20: полная, повторная без изменений данных и после добавления
+    100 комментариев (дописывание). В результатах также размер полной выгрузки в байтах
+    """
+    def run():
+        post, root = build_thread(size, 10, 'random')
+        entity_type = ContentType.objects.get_for_model(BlogPost)
+        comment_type = ContentType.objects.get_for_model(Comment)
+        repeat_export = min(repeat, 20)
+        results = {}
+        variants = [
+            (file_format, compressed)
+            for file_format, _ in CommentsAsFileTask.FILE_FORMAT_CHOICES
+            for compressed in (False, True)
+        ]
+        for file_format, compressed in variants:
+            tasks = []
+            name = f'{file_format}.gz' if compressed else file_format
+
+            def new_task():
+                tasks.append(CommentsAsFileTask.objects.create(
+                    entity_id=post.id, entity_type=entity_type, file_format=file_format, compressed=compressed
+                ))
+                return tasks[-1],
+
+            def exported_task(new_comments):
+                task, = new_task()
+                task.prepare_file()
+                Comment.objects.bulk_create_comments([
+                    Comment(author_id=root.author_id, text='new', parent_type=comment_type, parent_id=root.id)
+                    for _ in range(new_comments)
+                ], notify=False)
+                return task,
+
+            def prepare(task):
+                task.prepare_file()
+
+            try:
+                results[f'{name}_{size}'] = measure(prepare, repeat_export, setup=new_task)
+                results[f'{name}_{size}']['bytes'] = tasks[-1].file.size
+                results[f'{name}_{size}_unchanged'] = measure(
+                    prepare, repeat_export, setup=lambda: exported_task(0)
+                )
+                results[f'{name}_{size}_append_100'] = measure(
+                    prepare, repeat_export, setup=lambda: exported_task(100)
+                )
+            finally:
+                # Файлы лежат в storage, откат транзакции их не удалит
+                for task in tasks:
+                    task.file.delete(save=False)
+        return results
+    return run_in_rollback(run)
+
+
+def bench_connections(repeat=200):
+    """
+    Цикл запроса (request_started, SELECT 1, request_finished) при разном жизненном цикле соединения:
+    новое на каждый запрос, постоянное (CONN_MAX_AGE), из пула процесса и через pgbouncer (если задан PGBOUNCER_HOST)
+    """
+    base = {key: value for key, value in connections.databases['default'].items() if key != 'POOL'}
+    modes = {
+        'per_request': {'CONN_MAX_AGE': 0},
+        'persistent': {'CONN_MAX_AGE': 300},
+        'pool': {'CONN_MAX_AGE': 0, 'POOL': {'MAX_SIZE': 4}},
+    }
+    if os.getenv('PGBOUNCER_HOST'):
+        modes['pgbouncer'] = {
+            'CONN_MAX_AGE': 0, 'HOST': os.getenv('PGBOUNCER_HOST'), 'PORT': int(os.getenv('PGBOUNCER_PORT', 6432))
+        }
+    results = {}
+    for name, options in modes.items():
+        alias = f'benchmark_{name}'
+        connections.databases[alias] = dict(base, **options)
+
+        def request():
+            signals.request_started.send(sender=None)
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+            signals.request_finished.send(sender=None)
+        try:
+            results[name] = measure(request, repeat)
+        finally:
+            connections[alias].close()
+            close_pool(alias)
+            del connections[alias]
+            del connections.databases[alias]
+    return results
+
+
+BENCHMARKS = {
+    'insert': bench_insert,
+    'delete': bench_delete,
+    'delete_subtree': bench_delete_subtree,
+    'root': bench_root,
+    'children': bench_children,
+    'batch': bench_batch,
+    'descendants': bench_descendants,
+    'move': bench_move,
+    'export': bench_export,
+    'connections': bench_connections,
+}
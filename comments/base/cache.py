@@ -0,0 +1,158 @@
+import time
+from hashlib import md5
+from uuid import uuid4
+
+from rest_framework.response import Response
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from . import metrics
+from .routers import read_from_replica, replica_enabled
+
+
+def get_cache():
+    return caches[settings.COMMENTS_CACHE_ALIAS]
+
+
+# Снимает блокировку, только если она все еще наша: по истечении TTL ее мог взять другой процесс
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def get_connection():
+    from django_redis import get_redis_connection
+    return get_redis_connection(settings.COMMENTS_CACHE_ALIAS)
+
+
+def acquire_lock(cache, lock_key, token):
+    try:
+        connection = get_connection()
+    except NotImplementedError:
+        return cache.add(lock_key, token, settings.COMMENTS_CACHE_LOCK_TIMEOUT)
+    return bool(connection.set(cache.make_key(lock_key), token, ex=settings.COMMENTS_CACHE_LOCK_TIMEOUT, nx=True))
+
+
+def release_lock(cache, lock_key, token):
+    try:
+        connection = get_connection()
+    except NotImplementedError:
+        # Кеш без Redis локален для процесса, проверка и удаление не пересекаются с другими процессами
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+        return
+    connection.eval(RELEASE_LOCK_SCRIPT, 1, cache.make_key(lock_key), token)
+
+
+def get_or_compute(key, compute, timeout=None):
+    """
+    Read-through с защитой от stampede: пересчитывает значение только тот, кто взял блокировку,
+    остальные ждут его результат не дольше COMMENTS_CACHE_LOCK_TIMEOUT
+    """
+    cache = get_cache()
+    name = key.split(':', 1)[0]
+    value = cache.get(key)
+    if value is not None:
+        metrics.CACHE_REQUESTS.inc(cache=name, result='hit')
+        return value
+    lock_key = f'{key}:lock'
+    token = uuid4().hex
+    deadline = time.monotonic() + settings.COMMENTS_CACHE_LOCK_TIMEOUT
+    while not acquire_lock(cache, lock_key, token):
+        if time.monotonic() > deadline:
+            metrics.CACHE_REQUESTS.inc(cache=name, result='miss')
+            return compute()
+        time.sleep(0.05)
+        value = cache.get(key)
+        if value is not None:
+            metrics.CACHE_REQUESTS.inc(cache=name, result='wait')
+            return value
+    metrics.CACHE_REQUESTS.inc(cache=name, result='miss')
+    try:
+        value = compute()
+        cache.set(key, value, settings.COMMENTS_CACHE_TIMEOUT if timeout is None else timeout)
+    finally:
+        release_lock(cache, lock_key, token)
+    return value
+
+
+def _entity_version_key(entity_type_id, entity_id):
+    return f'entity-version:{entity_type_id}:{entity_id}'
+
+
+def _new_version():
+    # Время смены версии: сразу после изменений реплика может их еще не содержать
+    return f'{time.time():.3f}:{uuid4().hex}'
+
+
+def is_recent_version(version):
+    try:
+        changed_at = float(version.split(':', 1)[0])
+    except ValueError:
+        return False
+    return time.time() - changed_at < settings.COMMENTS_DB_PIN_SECONDS
+
+
+def get_entity_version(entity_type_id, entity_id):
+    cache = get_cache()
+    key = _entity_version_key(entity_type_id, entity_id)
+    version = cache.get(key)
+    if version is None:
+        # Версия могла быть вытеснена: новая версия делает недоступными все старые страницы сущности
+        cache.add(key, _new_version(), settings.COMMENTS_CACHE_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_entity(entity_type_id, entity_id):
+    """Сбрасывает закешированные страницы сущности после коммита изменений"""
+    transaction.on_commit(lambda: get_cache().set(
+        _entity_version_key(entity_type_id, entity_id), _new_version(), settings.COMMENTS_CACHE_VERSION_TIMEOUT
+    ))
+
+
+def get_parent_entity_key(parent):
+    """Сущность, к ветке которой относится parent = (parent_id, parent_type_id)"""
+    parent_id, parent_type_id = parent
+    Comment = apps.get_model('base', 'Comment')
+    if parent_type_id != ContentType.objects.get_for_model(Comment).id:
+        return parent_type_id, parent_id
+
+    def compute():
+        comment = Comment.objects.filter(id=parent_id).only(
+            'parent_type_id', 'parent_id', 'root_type_id', 'root_id'
+        ).first()
+        return comment.get_entity_key() if comment else None
+    return get_or_compute(f'comment-entity:{parent_id}', compute, settings.COMMENTS_CACHE_VERSION_TIMEOUT)
+
+
+def invalidate_comment_entities(comment_ids):
+    """Сбрасывает закешированные сущности комментариев после коммита их переноса в другую ветку"""
+    keys = [f'comment-entity:{comment_id}' for comment_id in comment_ids]
+    transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+class CachedListMixin(object):
+    """Кеширует ответ GET-списка комментариев ветки до следующего изменения в ее сущности"""
+
+    def list(self, request, *args, **kwargs):
+        parent = self.get_parent()
+        entity = get_parent_entity_key(parent) if parent else None
+        if entity is None:
+            return super().list(request, *args, **kwargs)
+        url = md5(request.build_absolute_uri().encode('utf-8')).hexdigest()
+        version = get_entity_version(*entity)
+        key = f'list:{self.__class__.__name__}:{version}:{url}'
+
+        def compute():
+            # Страница с отстающей реплики осталась бы в кеше до следующего изменения сущности
+            with read_from_replica(replica_enabled() and not is_recent_version(version)):
+                return super(CachedListMixin, self).list(request, *args, **kwargs).data
+        return Response(get_or_compute(key, compute))
@@ -0,0 +1,309 @@
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+
+from .seeding import WORDS
+
+# Доли запросов каждого вида в смеси
+MIXES = {
+    'read': {'list': 40, 'descendants': 25, 'tree': 15, 'user': 10, 'search': 10},
+    'mixed': {
+        'list': 30, 'descendants': 20, 'tree': 10, 'user': 5, 'search': 5, 'create': 15, 'update': 10, 'delete': 5
+    },
+    'write': {'create': 60, 'update': 25, 'delete': 15},
+    'export': {'list': 50, 'descendants': 30, 'export': 20},
+}
+DISPLAY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def parse_mix(value):
+    """Имя готовой смеси или список вида list=50,create=10"""
+    if value in MIXES:
+        return dict(MIXES[value])
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS or not weight.strip().isdigit():
+            raise ValueError(f'Bad mix item "{part}", expected <{"|".join(sorted(OPERATIONS))}>=<weight>')
+        mix[name] = int(weight)
+    if not any(mix.values()):
+        raise ValueError('Mix has no requests')
+    return mix
+
+
+class Histogram(object):
+    """Задержки в логарифмических корзинах с шагом 5%: перцентили с той же точностью при любой длине прогона"""
+    BASE = 1.05
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.buckets[max(0, math.ceil(math.log(max(ms, 0.01) / 0.01, self.BASE)))] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(0.01 * self.BASE ** bucket, self.max)
+        return self.max
+
+    def display(self):
+        """Число запросов в корзинах DISPLAY_BUCKETS_MS (последняя - все, что дольше)"""
+        counts = Counter()
+        for bucket, count in self.buckets.items():
+            upper = 0.01 * self.BASE ** bucket
+            counts[next((edge for edge in DISPLAY_BUCKETS_MS if upper <= edge), math.inf)] += count
+        return [(edge, counts[edge]) for edge in DISPLAY_BUCKETS_MS + (math.inf,) if counts[edge]]
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = Counter()
+        self.exceptions = Counter()
+
+    @property
+    def errors(self):
+        return sum(count for status, count in self.statuses.items() if status >= 500) + sum(self.exceptions.values())
+
+    @property
+    def client_errors(self):
+        return sum(count for status, count in self.statuses.items() if 400 <= status < 500)
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        self.statuses.update(other.statuses)
+        self.exceptions.update(other.exceptions)
+
+    def as_dict(self, elapsed):
+        requests = self.latency.count
+        return {
+            'requests': requests,
+            'rps': round(requests / elapsed, 1) if elapsed else 0,
+            'errors': self.errors,
+            'error_rate': round(self.errors / requests, 4) if requests else 0,
+            'client_errors': self.client_errors,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'exceptions': dict(self.exceptions),
+            'mean_ms': round(self.latency.total / requests, 2) if requests else 0,
+            'p50_ms': round(self.latency.percentile(50), 2),
+            'p90_ms': round(self.latency.percentile(90), 2),
+            'p99_ms': round(self.latency.percentile(99), 2),
+            'max_ms': round(self.latency.max, 2),
+            'histogram': [['inf' if edge == math.inf else edge, count] for edge, count in self.latency.display()],
+        }
+
+
+class Targets(object):
+    """Существующие данные, к которым обращаются запросы: выбираются из базы перед прогоном"""
+
+    def __init__(self, entities, threads, authors, comment_type_id):
+        self.entities = entities  # [(entity_type_id, entity_id)]
+        self.threads = threads  # id первых комментариев веток
+        self.authors = authors
+        self.comment_type_id = comment_type_id
+
+
+class Worker(threading.Thread):
+    """Закрытый цикл: следующий запрос уходит после ответа на предыдущий (или по расписанию при rate)"""
+
+    def __init__(self, base_url, mix, targets, deadline, warmup_until, interval=None, seed=None):
+        super().__init__(daemon=True)
+        url = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.operations, self.weights = zip(*mix.items())
+        self.targets = targets
+        self.deadline = deadline
+        self.warmup_until = warmup_until
+        self.interval = interval
+        self.rng = random.Random(seed)
+        self.created = []
+        self.stats = {}
+        self.connection = None
+
+    def run(self):
+        scheduled = time.monotonic() + (self.rng.random() * self.interval if self.interval else 0)
+        while True:
+            if self.interval:
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                started = scheduled
+                scheduled += self.interval
+            else:
+                started = time.monotonic()
+            if started >= self.deadline:
+                break
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            self.execute(operation, started)
+        if self.connection is not None:
+            self.connection.close()
+
+    def execute(self, operation, started):
+        name, method, path, body = OPERATIONS[operation](self)
+        status, exception, data = None, None, None
+        try:
+            status, data = self.request(method, path, body)
+        except (OSError, http.client.HTTPException) as e:
+            exception = type(e).__name__
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        # При заданном rate задержка считается от запланированного времени: очередь тоже входит в замер
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if name == 'create' and status == 201:
+            self.created.append(json.loads(data)['id'])
+        if started < self.warmup_until:
+            return
+        stats = self.stats.setdefault(name, EndpointStats())
+        stats.latency.add(elapsed_ms)
+        if exception:
+            stats.exceptions[exception] += 1
+        else:
+            stats.statuses[status] += 1
+
+    def request(self, method, path, body=None):
+        if self.connection is None:
+            self.connection = self.connection_class(self.netloc, timeout=60)
+        headers = {'Accept': 'application/json'}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, self.prefix + path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+        return response.status, data
+
+    def random_entity(self):
+        return self.rng.choice(self.targets.entities)
+
+    def random_text(self):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(3, 30)))
+
+
+def op_list(worker):
+    entity_type_id, entity_id = worker.random_entity()
+    query = urlencode({'parent': entity_id, 'parent_type': entity_type_id, 'limit': 20})
+    return 'list', 'GET', f'/comments/?{query}', None
+
+
+def op_descendants(worker, tree=False):
+    query = {'parent': worker.rng.choice(worker.targets.threads), 'parent_type': worker.targets.comment_type_id}
+    if tree:
+        query['tree'] = 1
+    return 'tree' if tree else 'descendants', 'GET', f'/comments-descendants/?{urlencode(query)}', None
+
+
+def op_tree(worker):
+    return op_descendants(worker, tree=True)
+
+
+def op_user(worker):
+    return 'user', 'GET', f'/user-comments/{worker.rng.choice(worker.targets.authors)}/?limit=20', None
+
+
+def op_search(worker):
+    return 'search', 'GET', f'/comments-search/?{urlencode({"q": worker.rng.choice(WORDS), "limit": 20})}', None
+
+
+def op_create(worker):
+    if worker.rng.random() < 0.3:
+        parent_type_id, parent_id = worker.random_entity()
+    else:
+        parent_type_id, parent_id = worker.targets.comment_type_id, worker.rng.choice(worker.targets.threads)
+    return 'create', 'POST', '/comments/', {
+        'author': worker.rng.choice(worker.targets.authors),
+        'text': worker.random_text(),
+        'parent_id': parent_id,
+        'parent_type': parent_type_id
+    }
+
+
+def op_update(worker):
+    # Меняются и удаляются только комментарии, созданные этим прогоном
+    if not worker.created:
+        return op_create(worker)
+    return 'update', 'PATCH', f'/comments/{worker.rng.choice(worker.created)}/', {'text': worker.random_text()}
+
+
+def op_delete(worker):
+    if not worker.created:
+        return op_create(worker)
+    comment_id = worker.created.pop(worker.rng.randrange(len(worker.created)))
+    return 'delete', 'DELETE', f'/comments/{comment_id}/', None
+
+
+def op_export(worker):
+    entity_type_id, entity_id = worker.random_entity()
+    query = urlencode({'entity': entity_id, 'entity_type': entity_type_id})
+    return 'export', 'GET', f'/comments-as-file/?{query}', None
+
+
+OPERATIONS = {
+    'list': op_list,
+    'descendants': op_descendants,
+    'tree': op_tree,
+    'user': op_user,
+    'search': op_search,
+    'create': op_create,
+    'update': op_update,
+    'delete': op_delete,
+    'export': op_export,
+}
+
+
+def run(base_url, mix, targets, concurrency=16, duration=60, warmup=5, rate=None, seed=None):
+    """
+    Прогон смеси запросов: concurrency потоков в течение warmup + duration секунд,
+    результаты прогрева отбрасываются. rate - общее число запросов в секунду (по умолчанию без ограничения)
+    """
+    started = time.monotonic()
+    warmup_until = started + warmup
+    deadline = warmup_until + duration
+    interval = concurrency / rate if rate else None
+    workers = [
+        Worker(base_url, mix, targets, deadline, warmup_until, interval, seed=None if seed is None else seed + i)
+        for i in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = min(time.monotonic(), deadline) - warmup_until
+
+    stats, total = {}, EndpointStats()
+    for worker in workers:
+        for name, endpoint in worker.stats.items():
+            stats.setdefault(name, EndpointStats()).merge(endpoint)
+            total.merge(endpoint)
+    results = {name: endpoint.as_dict(elapsed) for name, endpoint in sorted(stats.items())}
+    results['total'] = total.as_dict(elapsed)
+    return {'duration': round(elapsed, 2), 'concurrency': concurrency, 'rate': rate, 'mix': mix, 'results': results}
@@ -0,0 +1,39 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from comments.base.models import Comment, Comment2Comment
+
+
+class Command(BaseCommand):
+    help = 'Заполняет root_type/root_id у комментариев, созданных до их появления'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        bounds = Comment.objects.filter(root_id__isnull=True).aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('Nothing to backfill')
+            return
+        # Корневой комментарий ветки - единственный предок, родитель которого не комментарий
+        sql = f'''
+            UPDATE {Comment._meta.db_table} AS comment
+            SET root_type_id = root.parent_type_id, root_id = root.parent_id
+            FROM {Comment2Comment._meta.db_table} AS link
+            JOIN {Comment._meta.db_table} AS root ON root.id = link.from_comment_id
+            WHERE link.to_comment_id = comment.id
+                AND root.parent_type_id <> %s
+                AND comment.root_id IS NULL
+                AND comment.id BETWEEN %s AND %s
+        '''
+        comment_type_id = ContentType.objects.get_for_model(Comment).id
+        total = 0
+        for start in range(bounds['min_id'], bounds['max_id'] + 1, batch_size):
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, [comment_type_id, start, start + batch_size - 1])
+                total += cursor.rowcount
+            self.stdout.write(f'{min(start + batch_size - 1, bounds["max_id"])}/{bounds["max_id"]}: {total} updated')
+        self.stdout.write(self.style.SUCCESS(f'Done, {total} comments updated'))
@@ -0,0 +1,67 @@
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from comments.base.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Замеры операций с деревом комментариев (данные создаются в откатываемой транзакции)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f'Из {", ".join(sorted(BENCHMARKS))}, по умолчанию все')
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--output', help='Сохранить результаты в JSON-файл')
+        parser.add_argument('--compare', help='JSON-файл предыдущего запуска для сравнения')
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+        baseline = {}
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as f:
+                    baseline = json.load(f)['results']
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f'Cannot read {options["compare"]}: {e}')
+
+        results = {}
+        for name in options['names'] or sorted(BENCHMARKS):
+            results[name] = BENCHMARKS[name](repeat=options['repeat'])
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for case, stats in results[name].items():
+                line = f'  {case:<28} ' + '  '.join(f'{k}={v}' for k, v in stats.items())
+                previous = baseline.get(name, {}).get(case)
+                if previous:
+                    line += '  ' + self.format_change(previous, stats)
+                self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump({
+                    'commit': self.get_commit(),
+                    'created_at': timezone.now().isoformat(),
+                    'repeat': options['repeat'],
+                    'results': results
+                }, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results saved to {options["output"]}'))
+
+    def format_change(self, previous, stats):
+        change = (stats['mean_ms'] - previous['mean_ms']) / previous['mean_ms'] * 100 if previous['mean_ms'] else 0
+        text = f'mean {change:+.1f}%'
+        if previous.get('queries') is not None and previous.get('queries') != stats.get('queries'):
+            text += f' queries {previous["queries"]}->{stats.get("queries")}'
+        style = self.style.ERROR if change > 10 else self.style.SUCCESS if change < -10 else str
+        return style(f'({text})')
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
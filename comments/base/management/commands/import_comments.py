@@ -0,0 +1,46 @@
+import json
+import sys
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from comments.base.serializers import CommentBulkItemSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Импорт комментариев из файла, по одному JSON-объекту на строку '
+        '(поля как у POST /comments/bulk/: author, text, parent_id, parent_type)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Путь к файлу или - для stdin')
+        parser.add_argument('--batch-size', type=int, default=settings.COMMENTS_BULK_MAX_SIZE)
+
+    def handle(self, *args, **options):
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        batch_size = min(options['batch_size'], settings.COMMENTS_BULK_MAX_SIZE)
+        lines = (line for line in enumerate(stream, start=1) if line[1].strip())
+        total = 0
+        with stream:
+            while True:
+                batch = list(islice(lines, batch_size))
+                if not batch:
+                    break
+                try:
+                    data = [json.loads(line) for _, line in batch]
+                except ValueError as e:
+                    raise CommandError(f'Invalid JSON in lines {batch[0][0]}-{batch[-1][0]}: {e}')
+                serializer = CommentBulkItemSerializer(data=data, many=True)
+                if not serializer.is_valid():
+                    errors = serializer.errors
+                    if isinstance(errors, list):
+                        errors = {f'line {number}': error for (number, _), error in zip(batch, errors) if error}
+                    raise CommandError(
+                        f'Imported {total} comments, then validation failed: '
+                        f'{json.dumps(errors, ensure_ascii=False)}'
+                    )
+                total += len(serializer.save())
+                self.stdout.write(f'{total} comments imported')
+        self.stdout.write(self.style.SUCCESS(f'Done, {total} comments imported'))
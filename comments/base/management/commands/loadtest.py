@@ -0,0 +1,103 @@
+import json
+import math
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+
+from comments.base import loadtest
+from comments.base.models import Comment
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный прогон HTTP API смесью запросов. Цели (сущности, ветки, авторы) берутся из базы, '
+        'заполните ее заранее командой seed_comments'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000', help='Адрес запущенного сервиса')
+        parser.add_argument(
+            '--mix', default='mixed',
+            help=f'Смесь запросов: {", ".join(loadtest.MIXES)} или список вида list=50,create=10 '
+                 f'(виды: {", ".join(loadtest.OPERATIONS)})'
+        )
+        parser.add_argument('--concurrency', type=int, default=16, help='Число одновременных клиентов')
+        parser.add_argument('--duration', type=int, default=60, help='Длительность замера, секунд')
+        parser.add_argument('--warmup', type=int, default=5, help='Прогрев перед замером, секунд')
+        parser.add_argument('--rate', type=float, default=None, help='Общее число запросов в секунду')
+        parser.add_argument('--targets', type=int, default=100, help='Сколько сущностей и веток брать из базы')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', help='Сохранить результаты в JSON-файл')
+
+    def handle(self, *args, **options):
+        try:
+            mix = loadtest.parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(e)
+        if options['concurrency'] < 1 or options['duration'] < 1:
+            raise CommandError('--concurrency and --duration must be positive')
+
+        targets = self.get_targets(options['targets'])
+        self.stdout.write(
+            f'{options["url"]}: {options["concurrency"]} clients, {options["duration"]}s '
+            f'(+{options["warmup"]}s warmup), mix {mix}'
+        )
+        report = loadtest.run(
+            options['url'], mix, targets,
+            concurrency=options['concurrency'],
+            duration=options['duration'],
+            warmup=options['warmup'],
+            rate=options['rate'],
+            seed=options['seed']
+        )
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Results saved to {options["output"]}'))
+
+    def get_targets(self, limit):
+        # Последние ветки: комментарии, родитель которых - сама сущность
+        threads = list(
+            Comment.objects.filter(parent_type=F('root_type'), parent_id=F('root_id'))
+            .order_by('-id').values_list('id', 'root_type_id', 'root_id')[:limit]
+        )
+        if not threads:
+            raise CommandError('No comments in the database, run seed_comments first')
+        authors = list(get_user_model().objects.order_by('-id').values_list('id', flat=True)[:limit])
+        return loadtest.Targets(
+            entities=sorted({(root_type_id, root_id) for _, root_type_id, root_id in threads}),
+            threads=[comment_id for comment_id, _, _ in threads],
+            authors=authors,
+            comment_type_id=ContentType.objects.get_for_model(Comment).id
+        )
+
+    def print_report(self, report):
+        results = report['results']
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'\n{"endpoint":<12} {"requests":>9} {"rps":>8} {"errors":>7} {"4xx":>6} '
+            f'{"mean":>8} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}'
+        ))
+        for name, stats in results.items():
+            line = (
+                f'{name:<12} {stats["requests"]:>9} {stats["rps"]:>8} {stats["error_rate"]:>7.2%} '
+                f'{stats["client_errors"]:>6} {stats["mean_ms"]:>8} {stats["p50_ms"]:>8} {stats["p90_ms"]:>8} '
+                f'{stats["p99_ms"]:>8} {stats["max_ms"]:>8}'
+            )
+            self.stdout.write(self.style.ERROR(line) if stats['errors'] else line)
+        self.stdout.write('(время в мс)')
+
+        for name, stats in results.items():
+            if name == 'total' or not stats['requests']:
+                continue
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}'))
+            widest = max(count for _, count in stats['histogram'])
+            for edge, count in stats['histogram']:
+                label = f'> {loadtest.DISPLAY_BUCKETS_MS[-1]}' if edge == 'inf' else f'<= {edge}'
+                bar = '#' * math.ceil(count / widest * 40)
+                self.stdout.write(f'  {label:>9} ms {count:>8} {bar}')
+            if stats['statuses'] or stats['exceptions']:
+                codes = ', '.join(f'{k}: {v}' for k, v in {**stats['statuses'], **stats['exceptions']}.items())
+                self.stdout.write(f'  {codes}')
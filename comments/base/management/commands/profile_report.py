@@ -0,0 +1,109 @@
+import math
+import statistics
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from comments.base.profiler import read_records
+
+SORT_KEYS = {
+    'max': lambda row: row['max_ms'],
+    'p95': lambda row: row['p95_ms'],
+    'total': lambda row: row['total_ms'],
+    'count': lambda row: row['records'],
+    'queries': lambda row: row['max_queries'],
+}
+
+
+class Command(BaseCommand):
+    help = 'Самые медленные endpoint-ы по записям профилировщика запросов (ProfilingMiddleware) в логе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Файлы лога, по умолчанию файл из LOGGING')
+        parser.add_argument('--sort', choices=sorted(SORT_KEYS), default='p95')
+        parser.add_argument('--limit', type=int, default=20, help='Сколько endpoint-ов показать')
+        parser.add_argument('--details', type=int, default=3, help='По скольким худшим endpoint-ам показать детали')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or [settings.LOGGING['handlers']['file']['filename']]
+        records = []
+        for path in paths:
+            try:
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    records.extend(read_records(f))
+            except OSError as e:
+                raise CommandError(f'Cannot read {path}: {e}')
+        if not records:
+            self.stdout.write('No profiler records, is COMMENTS_PROFILE_ENABLED set?')
+            return
+
+        by_endpoint = defaultdict(list)
+        for record in records:
+            by_endpoint[(record['view'], record['method'])].append(record)
+        rows = sorted(
+            (self.summarize(endpoint, items) for endpoint, items in by_endpoint.items()),
+            key=SORT_KEYS[options['sort']], reverse=True
+        )[:options['limit']]
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{"endpoint":<40} {"records":>7} {"slow":>5} {"p50":>9} {"p95":>9} {"max":>9} '
+            f'{"queries":>8} {"max q":>6}'
+        ))
+        for row in rows:
+            self.stdout.write(
+                f'{row["endpoint"]:<40} {row["records"]:>7} {row["slow"]:>5} {row["p50_ms"]:>9} '
+                f'{row["p95_ms"]:>9} {row["max_ms"]:>9} {row["mean_queries"]:>8} {row["max_queries"]:>6}'
+            )
+        self.stdout.write('(время в мс)')
+
+        for row in rows[:options['details']]:
+            self.write_details(row)
+
+    @staticmethod
+    def summarize(endpoint, items):
+        durations = sorted(r['duration_ms'] for r in items)
+        queries = [r['queries']['count'] for r in items]
+        return {
+            'endpoint': ' '.join(reversed(endpoint)),
+            'items': items,
+            'records': len(items),
+            'slow': sum(1 for r in items if r['reason'] == 'slow'),
+            'p50_ms': round(statistics.median(durations), 1),
+            'p95_ms': round(durations[math.ceil(len(durations) * 0.95) - 1], 1),
+            'max_ms': round(durations[-1], 1),
+            'total_ms': sum(durations),
+            'mean_queries': round(statistics.mean(queries), 1),
+            'max_queries': max(queries),
+        }
+
+    def write_details(self, row):
+        worst = max(row['items'], key=lambda r: r['duration_ms'])
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{row["endpoint"]}'))
+        self.stdout.write(
+            f'  worst: {worst["path"]} {worst["duration_ms"]} ms, status {worst["status"]}, '
+            f'{worst["queries"]["count"]} queries in {worst["queries"]["duration_ms"]} ms'
+        )
+        for query in worst['queries']['slowest'][:5]:
+            self.stdout.write(f'  {query["duration_ms"]:>9} ms  {self.one_line(query["sql"])}')
+        for query in worst['queries']['repeated'][:5]:
+            self.stdout.write(
+                f'  {query["duration_ms"]:>9} ms  x{query["count"]} {self.one_line(query["sql"])}'
+            )
+
+        # Функции из всех профилей endpoint-а по суммарному накопленному времени
+        functions = defaultdict(lambda: [0, 0.0])
+        profiled = [r['profile'] for r in row['items'] if r['profile']]
+        for profile in profiled:
+            for item in profile:
+                functions[item['function']][0] += item['calls']
+                functions[item['function']][1] += item['cumtime_ms']
+        if profiled:
+            self.stdout.write(f'  cProfile, {len(profiled)} sampled requests, cumulative ms / calls:')
+            for name, (calls, cumtime) in sorted(functions.items(), key=lambda f: -f[1][1])[:10]:
+                self.stdout.write(f'  {cumtime / len(profiled):>9.1f} {calls:>8}  {name}')
+
+    @staticmethod
+    def one_line(sql, width=150):
+        sql = ' '.join(sql.split())
+        return sql if len(sql) <= width else sql[:width - 3] + '...'
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from comments.base.models import CommentLog
+
+
+class Command(BaseCommand):
+    help = 'Удаляет записи лога изменений старше COMMENTS_LOG_RETENTION_DAYS небольшими пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.COMMENTS_LOG_RETENTION_DAYS)
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            self.stdout.write('Retention is disabled')
+            return
+        table = CommentLog._meta.db_table
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        total = 0
+        while True:
+            # Короткие транзакции не держат блокировки и не раздувают WAL одной большой операцией
+            with connection.cursor() as cursor:
+                cursor.execute(f'''
+                    DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table} WHERE created_at < %s LIMIT %s
+                    )
+                ''', [cutoff, options['batch_size']])
+                deleted = cursor.rowcount
+            total += deleted
+            if deleted < options['batch_size']:
+                break
+        self.stdout.write(self.style.SUCCESS(f'Done, {total} log records deleted'))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from comments.base.models import Comment, Comment2Comment
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает children_count и descendants_count по closure table и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        bounds = Comment.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No comments')
+            return
+        sql = f'''
+            UPDATE {Comment._meta.db_table} AS comment
+            SET children_count = counters.children, descendants_count = counters.descendants
+            FROM (
+                SELECT node.id,
+                    count(link.id) FILTER (WHERE link.depth = 1) AS children,
+                    count(link.id) AS descendants
+                FROM {Comment._meta.db_table} AS node
+                LEFT JOIN {Comment2Comment._meta.db_table} AS link
+                    ON link.from_comment_id = node.id AND link.depth > 0
+                WHERE node.id BETWEEN %s AND %s
+                GROUP BY node.id
+            ) AS counters
+            WHERE comment.id = counters.id
+                AND (comment.children_count <> counters.children OR comment.descendants_count <> counters.descendants)
+        '''
+        total = 0
+        for start in range(bounds['min_id'], bounds['max_id'] + 1, batch_size):
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, [start, start + batch_size - 1])
+                total += cursor.rowcount
+        self.stdout.write(self.style.SUCCESS(f'Done, {total} comments repaired'))
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from comments.base.seeding import SHAPES, build_forest
+
+
+class Command(BaseCommand):
+    help = 'Генерация тестовых деревьев комментариев: entities сущностей по threads веток из size комментариев'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entities', type=int, default=10)
+        parser.add_argument('--threads', type=int, default=10, help='Веток на сущность')
+        parser.add_argument('--size', type=int, default=20, help='Комментариев в ветке')
+        parser.add_argument('--depth', type=int, default=5, help='Максимальная глубина ветки')
+        parser.add_argument('--shape', choices=SHAPES, default='random')
+        parser.add_argument('--authors', type=int, default=50)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=None, help='Seed генератора для повторяемых данных')
+        parser.add_argument('--notify', action='store_true', help='Рассылать подписчикам события о создании')
+
+    def handle(self, *args, **options):
+        for name in ('entities', 'threads', 'size', 'depth', 'authors', 'batch_size'):
+            if options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be positive')
+        started = time.perf_counter()
+        posts = build_forest(
+            entities=options['entities'],
+            threads=options['threads'],
+            size=options['size'],
+            depth=options['depth'],
+            shape=options['shape'],
+            authors=options['authors'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+            notify=options['notify']
+        )
+        total = options['entities'] * options['threads'] * options['size']
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {total} comments for {len(posts)} blog posts '
+            f'(ids {posts[0].id}-{posts[-1].id}) in {time.perf_counter() - started:.1f}s'
+        ))
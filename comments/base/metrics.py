@@ -0,0 +1,193 @@
+"""
+Метрики в формате Prometheus. Процессы gunicorn и celery копят значения в памяти и в конце каждого
+запроса или задачи одним pipeline прибавляют их к счетчикам в Redis, поэтому /metrics отдает сумму
+по всем процессам и перезапуск воркера (max_requests) ничего не теряет.
+"""
+import json
+import logging
+import threading
+import time
+from collections import Counter as _Counter
+from functools import wraps
+
+from celery.signals import task_postrun, task_prerun
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+REGISTRY = {}
+
+_pending = _Counter()
+_pending_lock = threading.Lock()
+
+
+def get_connection():
+    from django_redis import get_redis_connection
+    return get_redis_connection(settings.COMMENTS_METRICS_CACHE_ALIAS)
+
+
+def _redis_key(name):
+    return f'{settings.COMMENTS_METRICS_KEY_PREFIX}:{name}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY[name] = self
+
+    def _add(self, labels, suffix, amount):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        field = json.dumps([str(labels[name]) for name in self.labelnames]) + '\t' + suffix
+        with _pending_lock:
+            _pending[(self.name, field)] += amount
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self, data):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._add(labels, 'value', amount)
+
+    def render(self, data):
+        for (values, _), value in sorted(data.items()):
+            yield f'{self.name}{self.format_labels(values)} {value}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        bucket = next((str(b) for b in self.buckets if value <= b), '+Inf')
+        self._add(labels, f'le={bucket}', 1)
+        self._add(labels, 'sum', value)
+        self._add(labels, 'count', 1)
+
+    def time(self, **labels):
+        """Декоратор: длительность вызова функции"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def render(self, data):
+        series = sorted({values for values, _ in data})
+        for values in series:
+            cumulative = 0
+            for bucket in [str(b) for b in self.buckets] + ['+Inf']:
+                cumulative += data.get((values, f'le={bucket}'), 0)
+                yield f'{self.name}_bucket{self.format_labels(values, [("le", bucket)])} {cumulative}'
+            yield f'{self.name}_sum{self.format_labels(values)} {data.get((values, "sum"), 0)}'
+            yield f'{self.name}_count{self.format_labels(values)} {data.get((values, "count"), 0)}'
+
+
+def flush():
+    """Прибавляет накопленные процессом значения к счетчикам в Redis"""
+    global _pending
+    with _pending_lock:
+        pending, _pending = _pending, _Counter()
+    if not pending or not settings.COMMENTS_METRICS_ENABLED:
+        return
+    try:
+        connection = get_connection()
+    except NotImplementedError:
+        # Кеш не на Redis (локальная разработка): метрики не собираются
+        return
+    try:
+        pipeline = connection.pipeline(transaction=False)
+        for (name, field), amount in pending.items():
+            pipeline.hincrbyfloat(_redis_key(name), field, amount)
+        pipeline.execute()
+    except Exception:
+        # Метрики не должны ломать запросы: значения теряются, ошибка пишется в лог
+        logger.warning('Failed to flush metrics', exc_info=True)
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    connection = get_connection()
+    pipeline = connection.pipeline(transaction=False)
+    for name in REGISTRY:
+        pipeline.hgetall(_redis_key(name))
+    lines = []
+    for metric, raw in zip(REGISTRY.values(), pipeline.execute()):
+        data = {}
+        for field, value in raw.items():
+            labels, suffix = field.decode().split('\t')
+            value = float(value)
+            data[(tuple(json.loads(labels)), suffix)] = int(value) if value.is_integer() else value
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.render(data))
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_DURATION = Histogram(
+    'comments_http_request_duration_seconds', 'Время обработки запроса', ('view', 'method', 'status')
+)
+REQUEST_DB_QUERIES = Histogram(
+    'comments_http_request_db_queries', 'Число SQL-запросов за один HTTP-запрос', ('view', 'method'),
+    buckets=QUERY_COUNT_BUCKETS
+)
+REQUEST_DB_DURATION = Histogram(
+    'comments_http_request_db_duration_seconds', 'Суммарное время SQL-запросов за один HTTP-запрос',
+    ('view', 'method')
+)
+CACHE_REQUESTS = Counter(
+    'comments_cache_requests_total', 'Обращения к кешу списков: hit, miss (пересчет) или wait (ожидание пересчета)',
+    ('cache', 'result')
+)
+SIGNAL_HANDLER_DURATION = Histogram(
+    'comments_signal_handler_duration_seconds', 'Время обработчиков сигналов моделей', ('handler',)
+)
+TASK_DURATION = Histogram(
+    'comments_celery_task_duration_seconds', 'Время выполнения задач celery', ('task', 'state'),
+    buckets=TASK_BUCKETS
+)
+
+_task_started = {}
+
+
+@task_prerun.connect
+def task_prerun_handler(task_id, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def task_postrun_handler(task_id, task, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.observe(time.perf_counter() - started, task=task.name, state=state or 'UNKNOWN')
+    flush()
@@ -0,0 +1,137 @@
+import cProfile
+import random
+import time
+from contextlib import ExitStack
+
+from rest_framework.permissions import SAFE_METHODS
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import metrics, profiler
+
+
+class QueryStats(object):
+    """execute_wrapper: считает SQL-запросы и их суммарное время"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - started)
+
+    def record(self, sql, duration):
+        self.count += 1
+        self.duration += duration
+
+
+class QueryLog(QueryStats):
+    """Кроме счетчиков запоминает тексты первых limit запросов с их временем"""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.statements = []
+
+    def record(self, sql, duration):
+        super().record(sql, duration)
+        if len(self.statements) < self.limit:
+            self.statements.append((sql, duration))
+
+
+def capture_queries(wrapper):
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(wrapper))
+    return stack
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class else match.view_name
+
+
+class MetricsMiddleware(object):
+    """Время, число и время SQL-запросов по каждому view. Ставится первым в MIDDLEWARE"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryStats()
+        started = time.perf_counter()
+        with capture_queries(queries):
+            response = self.get_response(request)
+        # У потоковых ответов (выгрузка файла) в замер не входит отдача тела
+        labels = {'view': get_view_name(request), 'method': request.method}
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - started, status=response.status_code, **labels)
+        metrics.REQUEST_DB_QUERIES.observe(queries.count, **labels)
+        metrics.REQUEST_DB_DURATION.observe(queries.duration, **labels)
+        metrics.flush()
+        return response
+
+
+class ProfilingMiddleware(object):
+    """
+    Включается COMMENTS_PROFILE_ENABLED. Доля COMMENTS_PROFILE_SAMPLE_RATE запросов профилируется cProfile,
+    запросы дольше COMMENTS_PROFILE_SLOW_THRESHOLD пишутся в лог всегда (без профиля, если не попали в выборку).
+    Под gevent выборка пишется только с SQL-запросами, см. profiler.cprofile_available
+    """
+
+    def __init__(self, get_response):
+        if not settings.COMMENTS_PROFILE_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.use_cprofile = profiler.cprofile_available()
+
+    def __call__(self, request):
+        sampled = random.random() < settings.COMMENTS_PROFILE_SAMPLE_RATE
+        profile = cProfile.Profile() if sampled and self.use_cprofile else None
+        queries = QueryLog(settings.COMMENTS_PROFILE_MAX_QUERIES)
+        started = time.perf_counter()
+        with capture_queries(queries):
+            if profile is not None:
+                profile.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        duration = time.perf_counter() - started
+        slow = duration >= settings.COMMENTS_PROFILE_SLOW_THRESHOLD
+        if slow or sampled:
+            profiler.log_request(
+                'slow' if slow else 'sampled', get_view_name(request), request, response.status_code,
+                duration, queries, profile, limit=settings.COMMENTS_PROFILE_TOP
+            )
+        return response
+
+
+class ReplicaPinMiddleware(object):
+    """
+    Read-your-writes: после успешного изменяющего запроса клиенту ставится cookie, пока она жива,
+    его чтения не уходят в реплику (request.db_pinned, см. ReplicaReadMixin). Без реплик не используется
+    """
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.db_pinned = settings.COMMENTS_DB_PIN_COOKIE in request.COOKIES
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                settings.COMMENTS_DB_PIN_COOKIE, '1', max_age=settings.COMMENTS_DB_PIN_SECONDS, httponly=True
+            )
+        return response
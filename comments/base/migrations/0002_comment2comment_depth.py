@@ -0,0 +1,57 @@
+# Generated by Django 2.1 on 2026-10-18 18:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        # Автоматическая промежуточная таблица Comment.descendants становится явной моделью,
+        # таблица в базе остается прежней
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Comment2Comment',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('from_comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='base.Comment')),
+                        ('to_comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='base.Comment')),
+                    ],
+                    options={
+                        'db_table': 'base_comment_descendants',
+                    },
+                ),
+                migrations.AlterUniqueTogether(
+                    name='comment2comment',
+                    unique_together={('from_comment', 'to_comment')},
+                ),
+                migrations.AlterField(
+                    model_name='comment',
+                    name='descendants',
+                    field=models.ManyToManyField(through='base.Comment2Comment', to='base.Comment'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='comment2comment',
+            name='depth',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        # Глубина связи = число предков потомка - число предков предка
+        migrations.RunSQL(
+            """
+            UPDATE base_comment_descendants AS link
+            SET depth = descendant.cnt - ancestor.cnt
+            FROM
+                (SELECT to_comment_id, count(*) AS cnt FROM base_comment_descendants GROUP BY to_comment_id) AS descendant,
+                (SELECT to_comment_id, count(*) AS cnt FROM base_comment_descendants GROUP BY to_comment_id) AS ancestor
+            WHERE descendant.to_comment_id = link.to_comment_id AND ancestor.to_comment_id = link.from_comment_id
+            """,
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.1 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_comment2comment_depth'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent_type', 'parent_id', 'created_at', 'id'], name='base_commen_parent__82552e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['author', 'created_at', 'id'], name='base_commen_author__bfd739_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1 on 2026-10-18 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_comment_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['entity_type', 'entity_id', 'id'], name='base_subscr_entity__75837b_idx'),
+        ),
+    ]
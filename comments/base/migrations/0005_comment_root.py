@@ -0,0 +1,29 @@
+# Generated by Django 2.1 on 2026-10-18 18:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('base', '0004_subscription_entity_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='root_id',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='root_type',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['root_type', 'root_id', 'created_at', 'id'], name='base_commen_root_ty_6dd403_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.1 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_comment_root'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='children_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='descendants_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE base_comment AS comment
+            SET children_count = counters.children, descendants_count = counters.descendants
+            FROM (
+                SELECT from_comment_id AS id,
+                    count(*) FILTER (WHERE depth = 1) AS children,
+                    count(*) AS descendants
+                FROM base_comment_descendants
+                WHERE depth > 0
+                GROUP BY from_comment_id
+            ) AS counters
+            WHERE comment.id = counters.id
+            """,
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.1 on 2026-10-18 18:12
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_comment_counters'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='commentlog',
+            options={'ordering': ['-created_at', '-id']},
+        ),
+        migrations.AlterField(
+            model_name='commentlog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='commentlog',
+            index=models.Index(fields=['comment_id', 'created_at'], name='base_commen_comment_039403_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='commentlog',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['created_at'], name='base_commen_created_cf5bc0_brin'),
+        ),
+    ]
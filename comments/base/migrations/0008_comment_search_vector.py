@@ -0,0 +1,34 @@
+# Generated by Django 2.1 on 2026-10-18 18:12
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_comment_log_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            """
+            CREATE TRIGGER base_comment_search_vector_update
+            BEFORE INSERT OR UPDATE OF text ON base_comment
+            FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, 'pg_catalog.russian', text);
+
+            UPDATE base_comment SET search_vector = to_tsvector('pg_catalog.russian', text);
+            """,
+            'DROP TRIGGER base_comment_search_vector_update ON base_comment;'
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='base_commen_search__4aad13_gin'),
+        ),
+    ]
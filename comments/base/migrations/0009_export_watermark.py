@@ -0,0 +1,54 @@
+# Generated by Django 2.1 on 2026-10-18 18:24
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_comment_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentsasfiletask',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='commentsasfiletask',
+            name='last_comment_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentsasfiletask',
+            name='last_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentsasfiletask',
+            name='processing_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='commentsasfiletask',
+            name='used_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['root_type', 'root_id', 'id'], name='base_commen_root_ty_6f1652_idx'),
+        ),
+        # Старые файлы выгружены в другом порядке и без отметки выгруженного: такие задачи
+        # удалит вместе с файлами первый же CommentsAsFileTask.objects.cleanup()
+        migrations.RunSQL(
+            "UPDATE base_commentsasfiletask SET used_at = '1970-01-01'",
+            migrations.RunSQL.noop
+        ),
+    ]
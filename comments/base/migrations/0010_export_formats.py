@@ -0,0 +1,23 @@
+# Generated by Django 2.1 on 2026-10-18 18:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_export_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentsasfiletask',
+            name='compressed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='commentsasfiletask',
+            name='file_format',
+            field=models.CharField(choices=[('xml', 'Xml'), ('json', 'Json'), ('ndjson', 'NDJSON'), ('csv', 'CSV')], max_length=10),
+        ),
+    ]
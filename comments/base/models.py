@@ -1,20 +1,41 @@
+import gzip
+import json
+import logging
+import math
+import operator
+import shutil
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
+from functools import reduce
 
-from rest_framework_xml.renderers import XMLRenderer
-
-from django.db import models, transaction
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Cast, RowNumber
+from django.core.files.base import File
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import BrinIndex, GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
 from django.contrib.contenttypes.models import ContentType
 
-from .tasks import process_comments_to_file_task
+from .renderers import StreamingXMLRenderer, StreamingJSONRenderer, StreamingNDJSONRenderer, StreamingCSVRenderer
+from . import metrics, streams
+from .backends import get_event_backend
+from .cache import invalidate_comment_entities, invalidate_entity
+from .tasks import process_comments_to_file_task, fanout_comment_event_task
+
+logger = logging.getLogger(__name__)
 
 ALLOWED_CONTENT_TYPES = ('comment', 'blogpost', 'userprofile')
 
+_NOT_COMPUTED = object()
+
 
 class BlogPost(models.Model):
     """Some entity 1"""
@@ -27,17 +48,195 @@ class UserProfile(models.Model):
 
 
 class CommentManager(models.Manager):
-    def get_descendants(self, parent, date_from=None, date_to=None):
+    def get_queryset(self):
+        # search_vector нужен только в условиях поиска, не тащим его в каждую выборку
+        return super().get_queryset().defer('search_vector')
+
+    def search(self, query, author_id=None, entity=(None, None), date_from=None, date_to=None):
+        """
+        Полнотекстовый поиск по GIN-индексу search_vector. rank - релевантность ts_rank,
+        умноженная на 10^6 и приведенная к целому, чтобы по ней можно было точно листать курсором.
+        """
+        query = SearchQuery(query, config=self.model.SEARCH_CONFIG)
+        queryset = self.get_queryset().filter(search_vector=query).annotate(
+            rank=Cast(
+                SearchRank(models.F('search_vector'), query) * models.Value(10 ** 6, output_field=models.FloatField()),
+                models.IntegerField()
+            )
+        )
+        entity_id, entity_type_id = entity
+        if author_id:
+            queryset = queryset.filter(author_id=author_id)
+        if entity_id and entity_type_id:
+            queryset = queryset.filter(root_id=entity_id, root_type_id=entity_type_id)
+        if date_from:
+            queryset = queryset.filter(created_at__gte=date_from)
+        if date_to:
+            queryset = queryset.filter(created_at__lte=date_to)
+        return queryset
+
+    def get_descendants(self, parent, date_from=None, date_to=None, max_depth=None):
         parent_id, parent_type_id = parent
-        relations = Comment2Comment.objects.filter(
-            from_comment__parent_id=parent_id,
-            from_comment__parent_type__id=parent_type_id
-        ).select_related('to_comment')
+        # Связь от прямого потомка parent до комментария: глубина относительно parent на 1 больше
+        relations = {
+            'ancestor_links__from_comment__parent_id': parent_id,
+            'ancestor_links__from_comment__parent_type_id': parent_type_id
+        }
+        if max_depth is not None:
+            relations['ancestor_links__depth__lt'] = max_depth
+        queryset = self.get_queryset().filter(**relations).annotate(
+            depth=models.F('ancestor_links__depth') + 1
+        )
         if date_from:
-            relations = relations.filter(to_comment__created_at__gte=date_from)
+            queryset = queryset.filter(created_at__gte=date_from)
         if date_to:
-            relations = relations.filter(to_comment__created_at__lte=date_to)
-        return [r.to_comment for r in relations]
+            queryset = queryset.filter(created_at__lte=date_to)
+        return queryset
+
+    def get_thread(self, parent, max_depth=None):
+        """
+        Потомки parent одним запросом в порядке обхода дерева (родитель, затем его ответы).
+        У каждого комментария заполнены depth и replies.
+        """
+        comments = list(self.get_descendants(parent, max_depth=max_depth).order_by('created_at', 'id'))
+        nodes = {c.id: c for c in comments}
+        comment_type_id = ContentType.objects.get_for_model(self.model).id
+        for comment in comments:
+            comment.replies = []
+        # После переноса старый ответ может оказаться под более новым родителем, порядок создания не важен
+        roots = []
+        for comment in comments:
+            parent_node = nodes.get(comment.parent_id) if comment.parent_type_id == comment_type_id else None
+            if parent_node is None:
+                roots.append(comment)
+            else:
+                parent_node.replies.append(comment)
+        thread, stack = [], roots[::-1]
+        while stack:
+            comment = stack.pop()
+            thread.append(comment)
+            stack.extend(comment.replies[::-1])
+        return thread
+
+    def bulk_create_comments(self, comments, notify=True):
+        """
+        Вставка пачки новых комментариев вместе со связями closure table несколькими запросами.
+        Родители должны уже существовать. Подписчики каждой сущности получают одно событие,
+        если не передан notify=False (генерация тестовых данных).
+        """
+        comment_type_id = ContentType.objects.get_for_model(self.model).id
+        parent_ids = {c.parent_id for c in comments if c.parent_type_id == comment_type_id}
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            Comment2Comment.objects.lock_ancestors(parent_ids, using=using)
+            parents = self.using(using).filter(id__in=parent_ids).only(
+                'parent_type_id', 'parent_id', 'root_type_id', 'root_id'
+            ).in_bulk()
+            if len(parents) < len(parent_ids):
+                # Ветку родителя удалили, пока вставка ждала блокировку
+                raise self.model.DoesNotExist('Parent comment does not exist')
+            for comment in comments:
+                if comment.parent_type_id == comment_type_id:
+                    comment.root_type_id, comment.root_id = parents[comment.parent_id].get_entity_key()
+                else:
+                    comment.root_type_id, comment.root_id = comment.parent_type_id, comment.parent_id
+            comments = self.using(using).bulk_create(comments)
+            Comment2Comment.objects.insert_nodes([
+                (comment.id, comment.parent_id if comment.parent_type_id == comment_type_id else None)
+                for comment in comments
+            ], using=using)
+            Comment2Comment.objects.update_ancestor_counters([
+                comment.id for comment in comments if comment.parent_type_id == comment_type_id
+            ], 1, using=using)
+            events = defaultdict(list)
+            for comment in comments:
+                events[(comment.root_type_id, comment.root_id)].append(comment.as_data())
+            for (entity_type_id, entity_id), payload in events.items():
+                invalidate_entity(entity_type_id, entity_id)
+                if notify:
+                    send_entity_event(entity_type_id, entity_id, {'event': 'BULK_CREATED', 'payload': payload})
+        return comments
+
+    def move_subtree(self, comment, parent):
+        """
+        Переносит comment со всеми потомками к parent = (parent_id, parent_type_id). Связи closure table,
+        счетчики предков и root потомков обновляются запросами на все поддерево, а не по комментарию
+        """
+        parent_id, parent_type_id = parent
+        comment_type_id = ContentType.objects.get_for_model(self.model).id
+        parent_comment_id = parent_id if parent_type_id == comment_type_id else None
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            links = Comment2Comment.objects
+            # Ответы в поддерево ждут переноса (lock_ancestors), как и переносы предков нового родителя.
+            # Проверки и сущности читаются уже под блокировками
+            locked = self.using(using).select_for_update().only(
+                'parent_type_id', 'parent_id', 'root_type_id', 'root_id'
+            ).get(id=comment.id)
+            if parent_comment_id is not None:
+                links.lock_ancestors([parent_comment_id], using=using)
+                if links.using(using).filter(from_comment_id=comment.id, to_comment_id=parent_comment_id).exists():
+                    raise ValueError('Comment can not be moved into its own subtree')
+                entity_type_id, entity_id = self.using(using).only(
+                    'parent_type_id', 'parent_id', 'root_type_id', 'root_id'
+                ).get(id=parent_comment_id).get_entity_key()
+            else:
+                entity_type_id, entity_id = parent_type_id, parent_id
+            old_entity = locked.get_entity_key()
+            subtree_ids = list(
+                links.using(using).filter(from_comment_id=comment.id).values_list('to_comment_id', flat=True)
+            )
+            links.update_subtree_counters(comment.id, -1, using=using)
+            links.move_subtree(comment.id, parent_comment_id, using=using)
+            links.update_subtree_counters(comment.id, 1, using=using)
+            self.using(using).filter(ancestor_links__from_comment_id=comment.id).update(
+                root_type_id=entity_type_id, root_id=entity_id
+            )
+            # updated_at: выгрузки должны увидеть новый parent_id даже при переносе внутри сущности
+            comment.updated_at = timezone.now()
+            self.using(using).filter(id=comment.id).update(
+                parent_type_id=parent_type_id, parent_id=parent_id, updated_at=comment.updated_at
+            )
+            comment.parent_type_id, comment.parent_id = parent_type_id, parent_id
+            comment.root_type_id, comment.root_id = entity_type_id, entity_id
+            invalidate_comment_entities(subtree_ids)
+            for entity in {old_entity, (entity_type_id, entity_id)}:
+                invalidate_entity(*entity)
+                send_entity_event(*entity, {'event': 'MOVED', 'payload': comment.as_data()})
+        return comment
+
+    def delete_subtree(self, comment, soft=False):
+        """
+        Удаляет comment со всеми ответами несколькими запросами по closure table, без сигналов на каждый
+        комментарий, сущность получает одно событие BULK_DELETED. soft=True оставляет поддерево в дереве
+        надгробиями (без текста, с deleted_at). Возвращает id удаленных комментариев
+        """
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            links = Comment2Comment.objects
+            # Ответы в поддерево ждут удаления (lock_ancestors) и затем не находят родителя,
+            # иначе их связи closure table ссылались бы на удаленные комментарии
+            locked = self.using(using).select_for_update().only(
+                'parent_type_id', 'parent_id', 'root_type_id', 'root_id'
+            ).filter(id=comment.id).first()
+            if locked is None:
+                return []
+            entity = locked.get_entity_key()
+            subtree_ids = list(
+                links.using(using).filter(from_comment_id=comment.id).values_list('to_comment_id', flat=True)
+            )
+            if soft:
+                now = timezone.now()
+                self.using(using).filter(
+                    ancestor_links__from_comment_id=comment.id, deleted_at__isnull=True
+                ).update(text='', deleted_at=now, updated_at=now)
+            else:
+                links.update_subtree_counters(comment.id, -1, using=using)
+                links.delete_subtree(comment.id, using=using)
+                invalidate_comment_entities(subtree_ids)
+            invalidate_entity(*entity)
+            send_entity_event(*entity, {'event': 'BULK_DELETED', 'payload': {'ids': subtree_ids, 'soft': soft}})
+        return subtree_ids
 
     def get_children(self, parent):
         parent_id, parent_type_id = parent
@@ -46,9 +245,50 @@ class CommentManager(models.Manager):
             parent_type_id=parent_type_id
         )
 
+    def get_children_batch(self, parents, limit):
+        """
+        Новейшие limit ответов каждого из parents одним запросом: ROW_NUMBER() и COUNT() по окну
+        (parent_type, parent_id) вместо запроса get_children на каждого родителя.
+        Возвращает {parent: (число всех ответов, [ответы от новых к старым])}
+        """
+        partition = [models.F('parent_type'), models.F('parent_id')]
+        queryset = reduce(operator.or_, (self.get_children(parent) for parent in parents)).annotate(
+            position=models.Window(
+                RowNumber(), partition_by=partition, order_by=[models.F('created_at').desc(), models.F('id').desc()]
+            ),
+            total=models.Window(models.Count('id'), partition_by=partition)
+        ).order_by()
+        # Фильтр по оконной функции возможен только во внешнем запросе
+        sql, params = queryset.query.sql_with_params()
+        totals, children = {}, defaultdict(list)
+        for comment in self.raw(
+            f'SELECT * FROM ({sql}) AS ranked WHERE position <= %s ORDER BY position', [*params, limit]
+        ):
+            parent = (comment.parent_id, comment.parent_type_id)
+            totals[parent] = comment.total
+            children[parent].append(comment)
+        return {parent: (totals.get(parent, 0), children[parent]) for parent in parents}
+
+    def get_entity_comments(self, entity, date_from=None, date_to=None):
+        entity_id, entity_type_id = entity
+        queryset = self.get_queryset().filter(root_id=entity_id, root_type_id=entity_type_id)
+        if date_from:
+            queryset = queryset.filter(created_at__gte=date_from)
+        if date_to:
+            queryset = queryset.filter(created_at__lte=date_to)
+        return queryset
+
 
 class Comment(models.Model):
+    DATA_FIELDS = ('id', 'created_at', 'author_id', 'parent_id', 'text')
+    # Конфигурация должна совпадать с триггером search_vector из миграции 0008
+    SEARCH_CONFIG = 'russian'
+
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # null у комментариев, которые не менялись с момента добавления поля
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+    # Мягко удаленный комментарий (надгробие): остается в дереве без текста
+    deleted_at = models.DateTimeField(null=True, blank=True)
     author = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     text = models.TextField()
 
@@ -56,15 +296,36 @@ class Comment(models.Model):
     parent_id = models.PositiveIntegerField(db_index=True)
     parent = GenericForeignKey('parent_type', 'parent_id')
 
-    descendants = models.ManyToManyField('self', symmetrical=False)
+    # Сущность, к которой относится вся ветка (заполняется при создании)
+    root_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, related_name='+', null=True)
+    root_id = models.PositiveIntegerField(null=True)
+    root = GenericForeignKey('root_type', 'root_id')
+
+    descendants = models.ManyToManyField(
+        'self', symmetrical=False, through='Comment2Comment', through_fields=('from_comment', 'to_comment')
+    )
     children = GenericRelation(
         'self', content_type_field='parent_type', object_id_field='parent_id'
     )
+    # Поддерживаются при создании и удалении, сверяются командой reconcile_comment_counters
+    children_count = models.PositiveIntegerField(default=0)
+    descendants_count = models.PositiveIntegerField(default=0)
+    # Заполняется триггером в базе при вставке и изменении text
+    search_vector = SearchVectorField(null=True, editable=False)
 
     objects = CommentManager()
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Ключи постраничного вывода ветки и истории пользователя (created_at, id)
+            models.Index(fields=['parent_type', 'parent_id', 'created_at', 'id']),
+            models.Index(fields=['author', 'created_at', 'id']),
+            models.Index(fields=['root_type', 'root_id', 'created_at', 'id']),
+            # Выгрузка сущности по возрастанию id и дописывание новых комментариев
+            models.Index(fields=['root_type', 'root_id', 'id']),
+            GinIndex(fields=['search_vector']),
+        ]
 
     def __str__(self):
         return self.text[:100]
@@ -72,12 +333,39 @@ class Comment(models.Model):
     def save(self, *args, **kwargs):
         if self.pk is None:
             with transaction.atomic():
-                super().save()
+                self.set_entity_key()
+                super().save(*args, **kwargs)
         else:
-            super().save()
+            super().save(*args, **kwargs)
+
+    def set_entity_key(self):
+        if self.parent_type_id == ContentType.objects.get_for_model(Comment).id:
+            # До вставки связей closure table: перенос ветки родителя должен закончиться раньше
+            Comment2Comment.objects.lock_ancestors([self.parent_id])
+            parent = Comment.objects.only(
+                'parent_type_id', 'parent_id', 'root_type_id', 'root_id'
+            ).get(id=self.parent_id)
+            self.root_type_id, self.root_id = parent.get_entity_key()
+        else:
+            self.root_type_id, self.root_id = self.parent_type_id, self.parent_id
+
+    def tombstone(self):
+        """Мягкое удаление: строки и связи closure table остаются, ответы не затрагиваются"""
+        self.text = ''
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['text', 'deleted_at', 'updated_at'])
+
+    def get_entity_key(self):
+        if self.root_id is None:
+            # Комментарий создан до появления root, см. команду backfill_comment_roots
+            root = self.get_root()
+            return root.parent_type_id, root.parent_id
+        return self.root_type_id, self.root_id
 
     def get_entity(self):
-        return self.get_root().parent
+        if self.root_id is None:
+            return self.get_root().parent
+        return self.root
 
     def get_root(self):
         content_type = ContentType.objects.get_for_model(Comment)
@@ -104,67 +392,318 @@ class Comment(models.Model):
         }
 
 
-Comment2Comment = Comment.descendants.through
+class Comment2CommentManager(models.Manager):
+    def lock_ancestors(self, comment_ids, using='default'):
+        """
+        FOR KEY SHARE на comment_ids и всех их предков: вставки ответов в одну ветку идут параллельно
+        и не мешают UPDATE счетчиков предков, а перенос и удаление поддерева (FOR UPDATE его корня)
+        ждут их и задерживают новые до своего коммита
+        """
+        if not comment_ids:
+            return
+        table = self.model._meta.db_table
+        comment_table = Comment._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                SELECT 1 FROM {comment_table}
+                WHERE id IN (SELECT from_comment_id FROM {table} WHERE to_comment_id = ANY(%s))
+                ORDER BY id
+                FOR KEY SHARE
+            ''', [list(comment_ids)])
+
+    def insert_node(self, comment_id, parent_id=None, using='default'):
+        """Связь комментария с собой и со всеми предками родителя одним INSERT ... SELECT"""
+        table = self.model._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO {table} (from_comment_id, to_comment_id, depth)
+                SELECT %s, %s, 0
+                UNION ALL
+                SELECT from_comment_id, %s, depth + 1 FROM {table} WHERE to_comment_id = %s
+            ''', [comment_id, comment_id, comment_id, parent_id])
+
+    def insert_nodes(self, nodes, using='default'):
+        """То же для пачки пар (comment_id, parent_id), parent_id - None для комментариев к сущности"""
+        if not nodes:
+            return
+        comment_ids, parent_ids = zip(*nodes)
+        table = self.model._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                INSERT INTO {table} (from_comment_id, to_comment_id, depth)
+                SELECT node.id, node.id, 0 FROM unnest(%s::integer[]) AS node(id)
+                UNION ALL
+                SELECT link.from_comment_id, node.id, link.depth + 1
+                FROM unnest(%s::integer[], %s::integer[]) AS node(id, parent_id)
+                JOIN {table} AS link ON link.to_comment_id = node.parent_id
+            ''', [list(comment_ids), list(comment_ids), list(parent_ids)])
+
+    def move_subtree(self, comment_id, parent_id=None, using='default'):
+        """
+        Переносит поддерево comment_id к parent_id (None - к сущности): удаляет связи старых предков
+        со всем поддеревом и вставляет произведение новых предков на поддерево
+        """
+        table = self.model._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                DELETE FROM {table} AS link
+                USING {table} AS ancestor, {table} AS descendant
+                WHERE ancestor.to_comment_id = %s AND ancestor.depth > 0
+                    AND descendant.from_comment_id = %s
+                    AND link.from_comment_id = ancestor.from_comment_id
+                    AND link.to_comment_id = descendant.to_comment_id
+            ''', [comment_id, comment_id])
+            if parent_id is None:
+                return
+            cursor.execute(f'''
+                INSERT INTO {table} (from_comment_id, to_comment_id, depth)
+                SELECT ancestor.from_comment_id, descendant.to_comment_id, ancestor.depth + descendant.depth + 1
+                FROM {table} AS ancestor
+                CROSS JOIN {table} AS descendant
+                WHERE ancestor.to_comment_id = %s AND descendant.from_comment_id = %s
+            ''', [parent_id, comment_id])
+
+    def delete_subtree(self, comment_id, using='default'):
+        """Удаляет комментарии поддерева comment_id и все их связи одним запросом"""
+        table = self.model._meta.db_table
+        comment_table = Comment._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                WITH subtree AS (
+                    SELECT to_comment_id AS id FROM {table} WHERE from_comment_id = %s
+                ), links AS (
+                    DELETE FROM {table} AS link USING subtree WHERE link.to_comment_id = subtree.id
+                )
+                DELETE FROM {comment_table} AS comment USING subtree WHERE comment.id = subtree.id
+            ''', [comment_id])
+
+    def update_subtree_counters(self, comment_id, sign, using='default'):
+        """Прибавляет (sign=1) или вычитает (sign=-1) поддерево comment_id из счетчиков его предков"""
+        table = self.model._meta.db_table
+        comment_table = Comment._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE {comment_table} AS comment
+                SET children_count = comment.children_count + %s * (link.depth = 1)::integer,
+                    descendants_count = comment.descendants_count + %s * subtree.size
+                FROM {table} AS link,
+                    (SELECT count(*) AS size FROM {table} WHERE from_comment_id = %s) AS subtree
+                WHERE link.to_comment_id = %s AND link.depth > 0 AND comment.id = link.from_comment_id
+            ''', [sign, sign, comment_id, comment_id])
+
+    def update_ancestor_counters(self, comment_ids, sign, using='default'):
+        """Прибавляет (sign=1) или вычитает (sign=-1) комментарии comment_ids из счетчиков их предков"""
+        if not comment_ids:
+            return
+        table = self.model._meta.db_table
+        comment_table = Comment._meta.db_table
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'''
+                UPDATE {comment_table} AS comment
+                SET children_count = comment.children_count + %s * delta.children,
+                    descendants_count = comment.descendants_count + %s * delta.descendants
+                FROM (
+                    SELECT from_comment_id AS id,
+                        count(*) FILTER (WHERE depth = 1) AS children,
+                        count(*) AS descendants
+                    FROM {table}
+                    WHERE to_comment_id = ANY(%s) AND depth > 0
+                    GROUP BY from_comment_id
+                ) AS delta
+                WHERE comment.id = delta.id
+            ''', [sign, sign, list(comment_ids)])
+
+
+class Comment2Comment(models.Model):
+    """Closure table: связь предка с потомком, depth - расстояние между ними (0 - связь с собой)"""
+    from_comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='descendant_links')
+    to_comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField(default=0)
+
+    objects = Comment2CommentManager()
+
+    class Meta:
+        db_table = 'base_comment_descendants'
+        unique_together = ('from_comment', 'to_comment')
 
 
 class CommentLog(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now)
     comment_id = models.PositiveIntegerField()
     event = models.CharField(max_length=10)
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, null=True)
     changes = JSONField(default=dict)
 
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['comment_id', 'created_at']),
+            # Компактный индекс для удаления старых записей по времени
+            BrinIndex(fields=['created_at']),
+        ]
 
     @classmethod
     def push(cls, event, *, user=None, instance=None, update=None):
         changes = {}
-        if instance and update and instance.text != update['text']:
-            changes['before'] = {'text': instance.text}
-            changes['after'] = {'text': update['text']}
-        cls.objects.create(user=user, event=event, comment_id=instance.id, changes=changes)
+        if instance and update:
+            changed = [field for field in update if getattr(instance, field) != update[field]]
+            if changed:
+                changes['before'] = {field: getattr(instance, field) for field in changed}
+                changes['after'] = {field: update[field] for field in changed}
+        CommentLogBuffer.add([{
+            'created_at': timezone.now().isoformat(),
+            'comment_id': instance.id,
+            'event': event,
+            'user_id': user.id if user else None,
+            'changes': changes
+        }])
+
+    @classmethod
+    def push_many(cls, event, comment_ids, *, user=None):
+        """Одна запись на каждый комментарий пачки, без изменений"""
+        created_at = timezone.now().isoformat()
+        CommentLogBuffer.add([
+            {
+                'created_at': created_at,
+                'comment_id': comment_id,
+                'event': event,
+                'user_id': user.id if user else None,
+                'changes': {}
+            }
+            for comment_id in comment_ids
+        ])
+
+    @classmethod
+    def write(cls, entries):
+        cls.objects.bulk_create([
+            cls(**dict(entry, created_at=parse_datetime(entry['created_at']))) for entry in entries
+        ])
+
+
+class CommentLogBuffer(object):
+    """
+    Записи лога после коммита транзакции, в которой они сделаны, копятся в списке Redis (при откате
+    отбрасываются вместе с ней). Задача flush_comment_logs_task по расписанию celery beat пишет их в базу
+    пачками - одна вставка на много запросов. С COMMENTS_LOG_ASYNC=False или кешем не на Redis записи
+    вставляются сразу после коммита. Время записи фиксируется в момент события, поэтому порядок в логе
+    не зависит от момента вставки.
+    """
+
+    @staticmethod
+    def get_connection():
+        from django_redis import get_redis_connection
+        return get_redis_connection(settings.COMMENTS_LOG_CACHE_ALIAS)
+
+    @classmethod
+    def add(cls, entries, using=None):
+        using = using or router.db_for_write(CommentLog)
+        transaction.on_commit(lambda: cls.enqueue(entries), using=using)
+
+    @classmethod
+    def enqueue(cls, entries):
+        if settings.COMMENTS_LOG_ASYNC:
+            try:
+                cls.get_connection().rpush(settings.COMMENTS_LOG_BUFFER_KEY, *map(json.dumps, entries))
+                return
+            except NotImplementedError:
+                # Кеш не на Redis (локальная разработка)
+                pass
+            except Exception:
+                logger.warning('Failed to buffer comment log entries, writing them directly', exc_info=True)
+        CommentLog.write(entries)
+
+    @classmethod
+    def flush(cls):
+        """Переносит накопленные записи в базу пачками по COMMENTS_LOG_FLUSH_BATCH_SIZE, возвращает их число"""
+        try:
+            connection = cls.get_connection()
+        except NotImplementedError:
+            return 0
+        key, size = settings.COMMENTS_LOG_BUFFER_KEY, settings.COMMENTS_LOG_FLUSH_BATCH_SIZE
+        total = 0
+        while True:
+            # Чтение и обрезка списка в одной транзакции Redis: параллельные flush не пишут записи дважды
+            pipeline = connection.pipeline()
+            pipeline.lrange(key, 0, size - 1)
+            pipeline.ltrim(key, size, -1)
+            raw, _ = pipeline.execute()
+            if not raw:
+                return total
+            try:
+                CommentLog.write([json.loads(item) for item in raw])
+            except Exception:
+                # Возвращаем пачку в начало списка, следующий запуск повторит запись
+                connection.lpush(key, *reversed(raw))
+                raise
+            total += len(raw)
 
 
 class CommentsAsFileTaskQuerySet(models.QuerySet):
     def create_task(self, file_format='xml', author_id=None, entity_id=None, entity_type_id=None,
-                    date_from=None, date_to=None):
+                    date_from=None, date_to=None, compressed=None):
+        """
+        Выгрузка с такими параметрами переиспользуется, пока ее данные не изменились.
+        Возвращает (created, task), task.ready - файл актуален и его можно отдавать
+        """
         assert author_id or entity_id and entity_type_id
         self.cleanup()
         params = {
             'file_format': file_format,
+            'compressed': settings.COMMENTS_EXPORT_GZIP if compressed is None else compressed,
             'author_id': author_id,
             'entity_id': entity_id,
             'entity_type_id': entity_type_id,
             'date_from': date_from,
             'date_to': date_to,
         }
+        now = timezone.now()
         task = self.filter(**params).first()
-        created = False
         if task is None:
-            task = self.create(**params)
-            created = True
+            task = self.create(processing_started_at=now, used_at=now, **params)
+            process_comments_to_file_task.delay(task.id)
+            return True, task
+        self.filter(pk=task.pk).update(used_at=now)
+        if task.processing:
+            if task.processing_started_at > now - timedelta(seconds=self.model.PROCESSING_TIMEOUT):
+                return False, task
+        elif task.get_changes() is None:
+            return False, task
+        # Данные изменились или обработка зависла: задачу ставит только один из одновременных запросов
+        if self.filter(pk=task.pk, processing_started_at=task.processing_started_at).update(
+                processing_started_at=now):
             process_comments_to_file_task.delay(task.id)
-        return created, task
+        task.processing_started_at = now
+        return False, task
 
     def cleanup(self):
         self.filter(
-            created_at__lt=timezone.now() - timedelta(seconds=self.model.EXPIRE_TIME)
+            used_at__lt=timezone.now() - timedelta(seconds=self.model.EXPIRE_TIME)
         ).delete()
 
 
 class CommentsAsFileTask(models.Model):
-    EXPIRE_TIME = 60 * 60  # seconds
+    EXPIRE_TIME = 60 * 60 * 24  # seconds since the last request
+    PROCESSING_TIMEOUT = 60 * 60  # seconds, then processing is restarted
+    CHUNK_SIZE = 2000  # rows per server-side cursor fetch
+    COPY_BLOCK_SIZE = 1024 * 1024
+    COMPRESS_LEVEL = 6  # gzip, 9 заметно медленнее при почти том же размере
+    PARTS_DIR = 'comments/parts'
     FILE_FORMAT_CHOICES = (
         ('xml', 'Xml'),
-        ('json', 'Json')
+        ('json', 'Json'),
+        ('ndjson', 'NDJSON'),
+        ('csv', 'CSV')
     )
     CONTENT_TYPES = {
         'xml': 'text/xml',
-        'json': 'application/json'
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv'
     }
 
     created_at = models.DateTimeField(auto_now_add=True)
+    used_at = models.DateTimeField(default=timezone.now)
+    processing_started_at = models.DateTimeField(blank=True, null=True)
     author_id = models.PositiveIntegerField(blank=True, null=True)
     entity_id = models.PositiveIntegerField(blank=True, null=True)
     entity_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, blank=True, null=True)
@@ -172,33 +711,259 @@ class CommentsAsFileTask(models.Model):
     date_to = models.DateField(blank=True, null=True)
     file_format = models.CharField(max_length=10, choices=FILE_FORMAT_CHOICES)
     file = models.FileField(blank=True, null=True, upload_to='comments/')
+    # Файл хранится сжатым gzip
+    compressed = models.BooleanField(default=False)
+    # Что уже выгружено в файл (комментарии идут по возрастанию id)
+    last_comment_id = models.PositiveIntegerField(blank=True, null=True)
+    comments_count = models.PositiveIntegerField(default=0)
+    last_updated_at = models.DateTimeField(blank=True, null=True)
 
     objects = CommentsAsFileTaskQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
 
+    @property
+    def processing(self):
+        return self.processing_started_at is not None
+
     @property
     def ready(self):
-        return bool(self.file)
+        return bool(self.file) and not self.processing
 
     @property
     def file_content_type(self):
         return self.CONTENT_TYPES.get(self.file_format)
 
-    def prepare_file(self):
+    def get_changes(self):
+        """
+        Что изменилось с момента выгрузки: None - ничего, 'append' - добавлены только комментарии
+        новее last_comment_id, 'full' - выгруженные комментарии изменены или удалены
+        """
+        if not self.file:
+            return 'full'
+        exported = models.Q(id__lte=self.last_comment_id or 0)
+        state = self.get_comments().order_by().aggregate(
+            total=models.Count('id'),
+            exported=models.Count('id', filter=exported),
+            updated_at=models.Max('updated_at', filter=exported)
+        )
+        if state['exported'] != self.comments_count:
+            return 'full'
+        if state['updated_at'] and (self.last_updated_at is None or state['updated_at'] > self.last_updated_at):
+            return 'full'
+        if state['total'] != state['exported']:
+            return 'append'
+        return None
+
+    def prepare_file(self, changes=_NOT_COMPUTED):
+        # None из get_changes значит "файл актуален", поэтому не переданное значение отличается от None
+        if changes is _NOT_COMPUTED:
+            changes = self.get_changes()
+        if changes is not None:
+            self.write_file(append=changes == 'append')
+        self.finish_processing()
+
+    def finish_processing(self):
+        self.processing_started_at = None
+        self.save(update_fields=[
+            'file', 'last_comment_id', 'comments_count', 'last_updated_at', 'processing_started_at'
+        ])
+
+    def write_file(self, append=False):
+        """
+        Пишет новый файл: при append копирует тело старого без footer и дописывает только новые
+        комментарии, это дешевле полной выгрузки. Старый файл удаляется после замены,
+        уже начатые скачивания дочитывают его из открытого дескриптора
+        """
+        renderer = self.get_renderer()
+        comments = self.get_comments().only(*Comment.DATA_FIELDS, 'updated_at').order_by('id')
+        with tempfile.TemporaryFile() as tmp:
+            append = append and self.copy_body(renderer, tmp)
+            if append:
+                comments = comments.filter(id__gt=self.last_comment_id or 0)
+            else:
+                self.last_comment_id, self.comments_count, self.last_updated_at = None, 0, None
+            has_items = self.comments_count > 0
+            items = self.track_exported(self.iterate(comments))
+            with self.open_output(tmp) as output:
+                for chunk in renderer.render_stream(items, append=append, has_items=has_items):
+                    output.write(chunk)
+            self.replace_file(tmp)
+
+    @contextmanager
+    def open_output(self, target):
+        """Запись в файл выгрузки, у сжатой каждая запись - отдельный член gzip (их можно склеивать)"""
+        if not self.compressed:
+            yield target
+            return
+        with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=self.COMPRESS_LEVEL, mtime=0) as output:
+            yield output
+
+    def write_compressed(self, target, data):
+        if data:
+            with self.open_output(target) as output:
+                output.write(data)
+
+    def get_file_name(self):
+        name = f'comment-{self.id}.{self.file_format}'
+        return name + '.gz' if self.compressed else name
+
+    def replace_file(self, tmp):
+        old_name = self.file.name if self.file else None
+        tmp.seek(0)
+        self.file.save(self.get_file_name(), File(tmp), save=False)
+        if old_name:
+            self.file.storage.delete(old_name)
+
+    def get_shard_bounds(self):
+        """
+        Диапазоны id (after_id, upto_id] для параллельной полной выгрузки: в каждом не меньше
+        COMMENTS_EXPORT_SHARD_SIZE комментариев, диапазонов не больше COMMENTS_EXPORT_MAX_SHARDS,
+        у последнего upto_id None
+        """
+        ids = self.get_comments().order_by('id').values_list('id', flat=True)
+        total = ids.count()
+        size = max(settings.COMMENTS_EXPORT_SHARD_SIZE, math.ceil(total / settings.COMMENTS_EXPORT_MAX_SHARDS))
+        bounds = []
+        after_id = 0
+        for _ in range(math.ceil(total / size) - 1):
+            boundary = list(ids.filter(id__gt=after_id)[size - 1:size])
+            if not boundary:
+                break
+            bounds.append((after_id, boundary[0]))
+            after_id = boundary[0]
+        bounds.append((after_id, None))
+        return bounds
+
+    def get_part_name(self, index):
+        return f'{self.PARTS_DIR}/comment-{self.id}-{index}.part'
+
+    def write_part(self, index, after_id, upto_id=None):
+        """
+        Пишет часть выгрузки с комментариями из диапазона id без header и footer.
+        Возвращает имя файла части и что в нее попало (для водяной отметки выгрузки)
+        """
         renderer = self.get_renderer()
-        data = [c.as_data() for c in self.get_comments()]
-        self.file.save(
-            f'comment-{self.id}.{self.file_format}',
-            ContentFile(renderer.render(data))
+        comments = self.get_comments().only(*Comment.DATA_FIELDS, 'updated_at').order_by('id').filter(
+            id__gt=after_id
         )
+        if upto_id is not None:
+            comments = comments.filter(id__lte=upto_id)
+        self.last_comment_id, self.comments_count, self.last_updated_at = None, 0, None
+        with tempfile.TemporaryFile() as tmp:
+            items = self.track_exported(self.iterate(comments))
+            with self.open_output(tmp) as output:
+                for chunk in renderer.render_items(items):
+                    output.write(chunk)
+            tmp.seek(0)
+            name = self.file.storage.save(self.get_part_name(index), File(tmp))
+        return {
+            'index': index,
+            'name': name,
+            'last_comment_id': self.last_comment_id,
+            'comments_count': self.comments_count,
+            'last_updated_at': self.last_updated_at.isoformat() if self.last_updated_at else None,
+        }
+
+    def merge_parts(self, parts):
+        """
+        Собирает файл из частей в порядке диапазонов и завершает обработку.
+        Результаты chord с redis backend приходят в порядке завершения задач, поэтому сортируются по index
+        """
+        renderer = self.get_renderer()
+        separator = renderer.separator.encode(renderer.charset)
+        self.last_comment_id, self.comments_count, self.last_updated_at = None, 0, None
+        with tempfile.TemporaryFile() as tmp:
+            self.write_compressed(tmp, renderer.header.encode(renderer.charset))
+            for part in sorted(parts, key=lambda part: part['index']):
+                if not part['comments_count']:
+                    continue
+                if self.comments_count:
+                    self.write_compressed(tmp, separator)
+                with self.file.storage.open(part['name'], 'rb') as source:
+                    shutil.copyfileobj(source, tmp, self.COPY_BLOCK_SIZE)
+                self.last_comment_id = part['last_comment_id']
+                self.comments_count += part['comments_count']
+                updated_at = parse_datetime(part['last_updated_at'] or '')
+                if updated_at and (self.last_updated_at is None or updated_at > self.last_updated_at):
+                    self.last_updated_at = updated_at
+            self.write_compressed(tmp, renderer.footer.encode(renderer.charset))
+            self.replace_file(tmp)
+        self.finish_processing()
+        self.delete_parts()
+
+    def delete_parts(self):
+        """Удаляет части выгрузки, в том числе оставшиеся от упавшей обработки"""
+        storage = self.file.storage
+        try:
+            _, names = storage.listdir(self.PARTS_DIR)
+        except OSError:
+            return
+        prefix = f'comment-{self.id}-'
+        for name in names:
+            if name.startswith(prefix):
+                storage.delete(f'{self.PARTS_DIR}/{name}')
+
+    def copy_body(self, renderer, target):
+        """
+        Копирует файл без footer, False - файла нет или он заканчивается не footer.
+        Сжатый файл копируется, только если у формата нет footer (ndjson, csv): новые данные
+        допишутся следующим членом gzip
+        """
+        footer = renderer.footer.encode(renderer.charset)
+        if self.compressed and footer:
+            return False
+        try:
+            with self.file.open('rb') as source:
+                size = self.file.size - len(footer)
+                if size < 0:
+                    return False
+                source.seek(size)
+                if source.read() != footer:
+                    return False
+                source.seek(0)
+                while size > 0:
+                    block = source.read(min(size, self.COPY_BLOCK_SIZE))
+                    target.write(block)
+                    size -= len(block)
+        except OSError:
+            return False
+        return True
+
+    def iterate(self, comments):
+        """
+        Комментарии по CHUNK_SIZE за раз. Через pgbouncer серверные курсоры отключены и iterator()
+        получил бы всю выборку в память, поэтому части выбираются по id
+        """
+        if not connections[comments.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+            yield from comments.iterator(chunk_size=self.CHUNK_SIZE)
+            return
+        last_id = 0
+        while True:
+            chunk = list(comments.filter(id__gt=last_id)[:self.CHUNK_SIZE])
+            yield from chunk
+            if len(chunk) < self.CHUNK_SIZE:
+                return
+            last_id = chunk[-1].id
+
+    def track_exported(self, comments):
+        for comment in comments:
+            self.last_comment_id = comment.id
+            self.comments_count += 1
+            if comment.updated_at and (self.last_updated_at is None or comment.updated_at > self.last_updated_at):
+                self.last_updated_at = comment.updated_at
+            yield comment.as_data()
 
     def get_renderer(self):
         if self.file_format == 'xml':
-            return XMLRenderer()
+            return StreamingXMLRenderer()
         if self.file_format == 'json':
-            pass
+            return StreamingJSONRenderer()
+        if self.file_format == 'ndjson':
+            return StreamingNDJSONRenderer()
+        if self.file_format == 'csv':
+            return StreamingCSVRenderer(fields=Comment.DATA_FIELDS)
         raise Exception('Undefined format type')
 
     def get_comments(self):
@@ -210,7 +975,7 @@ class CommentsAsFileTask(models.Model):
                 comments = comments.filter(created_at__lte=self.date_to)
             return comments
         if self.entity_id and self.entity_type_id:
-            return Comment.objects.get_descendants(
+            return Comment.objects.get_entity_comments(
                 (self.entity_id, self.entity_type_id),
                 date_from=self.date_from,
                 date_to=self.date_to
@@ -226,37 +991,59 @@ class Subscription(models.Model):
 
     class Meta:
         unique_together = ('user', 'entity_id', 'entity_type')
+        indexes = [
+            models.Index(fields=['entity_type', 'entity_id', 'id']),
+        ]
 
     def send_event(self, data):
-        # Отправка события через какой-то бэкенд
-        print(data)
+        get_event_backend().send(self, data)
+
+
+@receiver(models.signals.post_delete, sender=CommentsAsFileTask)
+def comments_as_file_task_delete_handler(sender, instance, **kwargs):
+    if instance.file:
+        instance.file.delete(save=False)
+    instance.delete_parts()
 
 
 @receiver(models.signals.post_save, sender=Comment)
-def comment_create_handler(sender, instance, created, **kwargs):
+@metrics.SIGNAL_HANDLER_DURATION.time(handler='comment_create_handler')
+def comment_create_handler(sender, instance, created, using, **kwargs):
     if created:
-        if isinstance(instance.parent, Comment):
-            ancestors = list(instance.parent.get_ancestors(include_self=True).values_list('id', flat=True))
-            ancestors.append(instance.id)
+        if instance.parent_type_id == ContentType.objects.get_for_model(Comment).id:
+            parent_id = instance.parent_id
         else:
-            ancestors = [instance.id]
-        Comment2Comment.objects.bulk_create([
-            Comment2Comment(from_comment_id=aid, to_comment_id=instance.id)
-            for aid in ancestors
-        ])
+            parent_id = None
+        Comment2Comment.objects.insert_node(instance.id, parent_id, using=using)
+        if parent_id is not None:
+            Comment2Comment.objects.update_ancestor_counters([instance.id], 1, using=using)
+
+
+@receiver(models.signals.pre_delete, sender=Comment)
+@metrics.SIGNAL_HANDLER_DURATION.time(handler='comment_delete_handler')
+def comment_delete_handler(sender, instance, using, **kwargs):
+    # Связи closure table еще не удалены
+    Comment2Comment.objects.update_ancestor_counters([instance.id], -1, using=using)
 
 
 @receiver([models.signals.post_save, models.signals.pre_delete], sender=Comment)
+@metrics.SIGNAL_HANDLER_DURATION.time(handler='comment_change_handler')
 def comment_change_handler(sender, instance, **kwargs):
-    entity = instance.get_entity()
-    subscriptions = Subscription.objects.filter(
-        entity_id=entity.id,
-        entity_type=ContentType.objects.get_for_model(entity._meta.model)
-    )
+    entity_type_id, entity_id = instance.get_entity_key()
     created = kwargs.get('created')
     if created is None:
         event = 'DELETE'
     else:
         event = 'CREATED' if created else 'UPDATED'
-    for subscription in subscriptions:
-        subscription.send_event({'event': event, 'payload': instance.as_data()})
+    invalidate_entity(entity_type_id, entity_id)
+    send_entity_event(entity_type_id, entity_id, {'event': event, 'payload': instance.as_data()})
+
+
+def send_entity_event(entity_type_id, entity_id, data):
+    # Рассылка подписчикам уходит в celery, а в поток ветки - сразу, но только после успешного коммита
+    transaction.on_commit(
+        lambda: fanout_comment_event_task.delay(entity_type_id, entity_id, data)
+    )
+    transaction.on_commit(
+        lambda: streams.publish(entity_type_id, entity_id, data)
+    )
@@ -0,0 +1,138 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничный вывод по ключу (created_at, id): следующая страница начинается сразу
+    после последней записи предыдущей, поэтому любая страница стоит столько же, сколько первая.
+    Порядок должен заканчиваться уникальным полем.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        values, reverse = self.decode_cursor(request, queryset)
+
+        ordering = [self._reverse(field) for field in self.ordering] if reverse else list(self.ordering)
+        if values is not None:
+            queryset = queryset.filter(self.get_keyset_filter(ordering, values))
+        results = list(queryset.order_by(*ordering)[:page_size + 1])
+
+        has_following = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_following
+        else:
+            self.has_next, self.has_previous = has_following, values is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_page_size(self, request):
+        page_size = request.query_params.get(self.page_size_query_param, '')
+        if page_size.isdigit() and int(page_size) > 0:
+            return min(int(page_size), self.max_page_size)
+        return self.page_size
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.get_position(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.get_position(self.page[0]), reverse=True)
+
+    def get_position(self, item):
+        return [getattr(item, field.lstrip('-')) for field in self.ordering]
+
+    def get_keyset_filter(self, ordering, values):
+        """
+        (f1, f2) < (v1, v2) в виде f1 <= v1 AND (f1 < v1 OR f1 = v1 AND f2 < v2):
+        первое условие задает диапазон для индекса, второе отсекает уже показанные записи
+        """
+        fields = [(field.lstrip('-'), 'lt' if field.startswith('-') else 'gt') for field in ordering]
+        name, lookup = fields[0]
+        bound = Q(**{f'{name}__{lookup}e': values[0]})
+        after = Q()
+        for i, (name, lookup) in enumerate(fields):
+            condition = Q(**{f'{name}__{lookup}': values[i]})
+            for (prev_name, _), prev_value in zip(fields[:i], values):
+                condition &= Q(**{prev_name: prev_value})
+            after |= condition
+        return bound & after
+
+    def decode_cursor(self, request, queryset):
+        """Значения курсора приводятся к типам полей порядка, иначе ошибка всплыла бы из базы как 500"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            values, reverse = cursor['v'], bool(cursor['r'])
+            assert isinstance(values, list) and len(values) == len(self.ordering)
+            values = [
+                self.get_ordering_field(queryset, field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+            assert None not in values
+        except (TypeError, ValueError, KeyError, AssertionError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    @staticmethod
+    def get_ordering_field(queryset, name):
+        # Поле порядка может быть аннотацией (rank в SearchPagination)
+        annotation = queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return queryset.model._meta.get_field(name)
+
+    def encode_cursor(self, values, reverse):
+        cursor = json.dumps({'v': values, 'r': int(reverse)}, default=self._encode_value)
+        encoded = urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    @staticmethod
+    def _encode_value(value):
+        # isoformat сохраняет микросекунды, без них ключ не совпадет с записью в базе
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+    @staticmethod
+    def _reverse(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+
+class SearchPagination(KeysetPagination):
+    """Результаты поиска по убыванию релевантности (rank - целое, см. CommentManager.search)"""
+    ordering = ('-rank', '-id')
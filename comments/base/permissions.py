@@ -1,6 +1,30 @@
 from rest_framework import permissions
 
 
+def is_soft_delete(request):
+    return request.method == 'DELETE' and request.query_params.get('soft') == '1'
+
+
 class HasChildrenPermission(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.method != 'DELETE' or not obj.children.exists()
+        # Мягкое удаление оставляет комментарий в дереве, ответы не теряются
+        return request.method != 'DELETE' or obj.children_count == 0 or is_soft_delete(request)
+
+
+class SoftDeletePermission(permissions.BasePermission):
+    """Мягкое удаление комментария с ответами - только модераторам (is_staff) и автору"""
+
+    def has_object_permission(self, request, view, obj):
+        if not is_soft_delete(request):
+            return True
+        return request.user.is_staff or request.user.is_authenticated and request.user.id == obj.author_id
+
+
+class NotDeletedPermission(permissions.BasePermission):
+    """Надгробие нельзя редактировать и мягко удалять повторно"""
+    message = 'Comment is deleted'
+
+    def has_object_permission(self, request, view, obj):
+        if request.method in ('PUT', 'PATCH') or is_soft_delete(request):
+            return obj.deleted_at is None
+        return True
@@ -0,0 +1,161 @@
+"""
+Backend postgresql с управлением жизненным циклом соединений:
+
+- соединение, не использовавшееся дольше HEALTH_CHECK_INTERVAL секунд, перед запросом проверяется
+  SELECT 1 и при ошибке открывается заново (перезапуск postgres, обрыв простаивающих соединений pgbouncer-ом);
+- POOL включает пул соединений процесса: close() возвращает соединение в пул, новое берется из него.
+  Нужен gevent воркерам: у каждого запроса свой greenlet, и CONN_MAX_AGE соединение не переживает запрос;
+- после fork (celery prefork, gunicorn preload) соединения родителя не закрываются из дочернего процесса:
+  закрытие отправило бы Terminate по общему сокету и сломало бы соединение родителя.
+"""
+import os
+import threading
+import time
+
+from django.db.backends.postgresql import base
+from psycopg2 import extensions
+
+Database = base.Database
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def is_alive(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except Database.Error:
+        return False
+    return True
+
+
+class ConnectionPool(object):
+    """Соединения одного алиаса базы в текущем процессе, не больше max_size одновременно"""
+
+    def __init__(self, max_size, timeout, max_idle, health_check_interval):
+        self.pid = os.getpid()
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self._idle = []  # (соединение, время возврата), последние возвращенные в конце
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def get(self, connect):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Database.OperationalError('Connection pool is exhausted')
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, returned_at = self._idle.pop()
+                idle = time.monotonic() - returned_at
+                if connection.closed or idle > self.max_idle:
+                    connection.close()
+                elif idle <= self.health_check_interval or is_alive(connection):
+                    return connection
+            return connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def put(self, connection):
+        try:
+            if os.getpid() != self.pid:
+                # Пул и соединение унаследованы от родителя, закрывать их здесь нельзя
+                return
+            if connection.closed or connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.close()
+                return
+            now = time.monotonic()
+            with self._lock:
+                self._idle.append((connection, now))
+                expired = [item for item in self._idle if now - item[1] > self.max_idle]
+                self._idle = [item for item in self._idle if now - item[1] <= self.max_idle]
+            for stale, _ in expired:
+                stale.close()
+        finally:
+            self._slots.release()
+
+    def clear(self):
+        """Закрывает свободные соединения, выданные остаются в работе"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+def get_pool(alias, settings_dict):
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None or pool.pid != os.getpid():
+            options = settings_dict['POOL']
+            pool = _pools[alias] = ConnectionPool(
+                max_size=options.get('MAX_SIZE', 20),
+                timeout=options.get('TIMEOUT', 10),
+                max_idle=options.get('MAX_IDLE', 300),
+                health_check_interval=settings_dict.get('HEALTH_CHECK_INTERVAL', 30)
+            )
+        return pool
+
+
+def close_pool(alias):
+    with _pools_lock:
+        pool = _pools.pop(alias, None)
+    if pool is not None and pool.pid == os.getpid():
+        pool.clear()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection_pid = None
+        self.used_at = 0
+
+    @property
+    def pool(self):
+        if not self.settings_dict.get('POOL'):
+            return None
+        return get_pool(self.alias, self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            connection = super().get_new_connection(conn_params)
+        else:
+            connection = pool.get(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+            options = self.settings_dict['OPTIONS']
+            self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        self.connection_pid = os.getpid()
+        self.used_at = time.monotonic()
+        return connection
+
+    def _cursor(self, name=None):
+        # Не в ensure_connection: его вызывает и сам connect() до включения autocommit
+        if self.connection is not None and not self.in_atomic_block and self.health_check_due():
+            if not self.is_usable():
+                self.close()
+            self.used_at = time.monotonic()
+        return super()._cursor(name)
+
+    def health_check_due(self):
+        interval = self.settings_dict.get('HEALTH_CHECK_INTERVAL')
+        return interval is not None and time.monotonic() - self.used_at > interval
+
+    def create_cursor(self, name=None):
+        self.used_at = time.monotonic()
+        return super().create_cursor(name)
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if self.connection_pid != os.getpid():
+            # Соединение родительского процесса: только забываем его
+            return
+        pool = self.pool
+        if pool is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.put(self.connection)
@@ -0,0 +1,101 @@
+"""
+Профилирование медленных запросов: доля случайных запросов профилируется cProfile, у всех запросов
+дольше порога сохраняются SQL-запросы. Записи уходят одной строкой JSON в логгер comments.base.profiler
+(обработчики логгера comments.base из LOGGING), отчет по ним строит команда profile_report.
+"""
+import json
+import logging
+import os
+import pstats
+import sys
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+RECORD_TYPE = 'request_profile'
+MAX_SQL_LENGTH = 2000
+
+
+def cprofile_available():
+    """
+    cProfile включается на весь поток ОС. Под gevent в нем выполняются все greenlet-ы воркера: профиль
+    смешал бы одновременные запросы, а второй профилируемый запрос отключил бы профиль первого
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return True
+    return not monkey.is_module_patched('threading')
+
+
+def summarize_queries(statements, limit):
+    """Самые долгие запросы и повторяющиеся (N+1) с суммарным временем"""
+    repeated = OrderedDict()
+    for sql, duration in statements:
+        total = repeated.setdefault(sql, [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+    return {
+        'slowest': [
+            {'sql': sql[:MAX_SQL_LENGTH], 'duration_ms': round(duration * 1000, 3)}
+            for sql, duration in sorted(statements, key=lambda s: -s[1])[:limit]
+        ],
+        'repeated': [
+            {'sql': sql[:MAX_SQL_LENGTH], 'count': count, 'duration_ms': round(duration * 1000, 3)}
+            for sql, (count, duration) in sorted(repeated.items(), key=lambda s: -s[1][1])
+            if count > 1
+        ][:limit],
+    }
+
+
+def _short_path(path):
+    for prefix in sorted(sys.path, key=len, reverse=True):
+        if prefix and path.startswith(prefix + os.sep):
+            return path[len(prefix) + 1:]
+    return path
+
+
+def summarize_profile(profile, limit):
+    """Функции с наибольшим накопленным временем"""
+    stats = pstats.Stats(profile).stats
+    rows = sorted(stats.items(), key=lambda item: -item[1][3])[:limit]
+    return [
+        {
+            'function': f'{_short_path(filename)}:{line}({name})',
+            'calls': calls,
+            'tottime_ms': round(tottime * 1000, 3),
+            'cumtime_ms': round(cumtime * 1000, 3),
+        }
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in rows
+    ]
+
+
+def log_request(reason, view, request, status, duration, queries, profile=None, limit=20):
+    record = {
+        'type': RECORD_TYPE,
+        'reason': reason,
+        'view': view,
+        'method': request.method,
+        'path': request.get_full_path()[:MAX_SQL_LENGTH],
+        'status': status,
+        'duration_ms': round(duration * 1000, 3),
+        'queries': {
+            'count': queries.count,
+            'duration_ms': round(queries.duration * 1000, 3),
+            **summarize_queries(queries.statements, limit)
+        },
+        'profile': summarize_profile(profile, limit) if profile is not None else None,
+    }
+    logger.info(json.dumps(record, ensure_ascii=False))
+
+
+def read_records(lines):
+    """Записи профилировщика из строк лога, остальные строки пропускаются"""
+    for line in lines:
+        start = line.find('{"type": "%s"' % RECORD_TYPE)
+        if start == -1:
+            continue
+        try:
+            yield json.loads(line[start:])
+        except ValueError:
+            continue
@@ -0,0 +1,99 @@
+import csv
+import json
+from io import StringIO
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_xml.renderers import XMLRenderer
+
+from django.utils.xmlutils import SimplerXMLGenerator
+
+
+class StreamingRendererMixin(object):
+    """Рендерит список элементов по одному, не собирая весь результат в памяти"""
+    header = ''
+    separator = ''
+    footer = ''
+
+    def render_item(self, item):
+        raise NotImplementedError
+
+    def render_stream(self, items, append=False, has_items=False):
+        """
+        append - дописывание в конец уже выведенного тела (без header и footer),
+        has_items - в нем уже есть элементы и перед первым новым нужен separator
+        """
+        if not append:
+            yield self.header.encode(self.charset)
+        yield from self.render_items(items, has_items=has_items)
+        yield self.footer.encode(self.charset)
+
+    def render_items(self, items, has_items=False):
+        """Только элементы через separator, без header и footer (часть выгрузки)"""
+        separator = self.separator if has_items else ''
+        for item in items:
+            yield (separator + self.render_item(item)).encode(self.charset)
+            separator = self.separator
+
+
+class StreamingXMLRenderer(StreamingRendererMixin, XMLRenderer):
+    @property
+    def header(self):
+        return f'<?xml version="1.0" encoding="{self.charset}"?>\n<{self.root_tag_name}>'
+
+    @property
+    def footer(self):
+        return f'</{self.root_tag_name}>'
+
+    def render_item(self, item):
+        stream = StringIO()
+        self._to_xml(SimplerXMLGenerator(stream, self.charset), [item])
+        return stream.getvalue()
+
+
+class StreamingJSONRenderer(StreamingRendererMixin, JSONRenderer):
+    charset = 'utf-8'
+    header = '['
+    separator = ','
+    footer = ']'
+
+    def render_item(self, item):
+        return json.dumps(item, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+class StreamingNDJSONRenderer(StreamingJSONRenderer):
+    """JSON Lines: объект на строку, файл можно дописывать и читать построчно"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    header = ''
+    separator = ''
+    footer = ''
+
+    def render_item(self, item):
+        return super().render_item(item) + '\n'
+
+
+class StreamingCSVRenderer(StreamingRendererMixin, BaseRenderer):
+    """CSV с заголовком из fields, строки по RFC 4180"""
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def __init__(self, fields=()):
+        self.fields = fields
+        self._buffer = StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    @property
+    def header(self):
+        return self._row(self.fields)
+
+    def render_item(self, item):
+        return self._row([item[field] for field in self.fields])
+
+    def _row(self, values):
+        self._writer.writerow(values)
+        row = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return row
@@ -0,0 +1,47 @@
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_state = threading.local()
+
+
+@contextmanager
+def read_from_replica(enabled=True):
+    """Чтения внутри блока идут в случайную реплику из DATABASE_REPLICAS, запись всегда в default"""
+    previous = replica_enabled()
+    _state.replica = enabled
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def replica_enabled():
+    return getattr(_state, 'replica', False)
+
+
+class ReplicaRouter(object):
+    """
+    Реплики используются только внутри read_from_replica: по умолчанию чтения остаются в default,
+    чтобы код, читающий сразу после записи, не видел отставания реплики
+    """
+
+    def db_for_read(self, model, **hints):
+        if replica_enabled() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и default
+        databases = {'default', *settings.DATABASE_REPLICAS}
+        return obj1._state.db in databases and obj2._state.db in databases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,82 @@
+import random
+
+from model_mommy import mommy
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+
+from .models import BlogPost, Comment
+
+SHAPES = ('random', 'wide', 'deep')
+WORDS = (
+    'комментарий', 'ответ', 'статья', 'кошка', 'собака', 'дерево', 'ветка', 'вопрос', 'спасибо', 'согласен',
+    'интересно', 'пример', 'ошибка', 'версия', 'сервер', 'данные', 'быстро', 'медленно', 'хорошо', 'плохо'
+)
+
+
+def plan_thread(size, depth, shape, rng):
+    """
+    Форма ветки из size комментариев: для каждого индекс родителя в ветке (None - сама сущность).
+    wide - все ответы на первый комментарий, deep - цепочки глубины depth,
+    random - каждый ответ на случайный комментарий, не превышая глубину depth
+    """
+    parents, levels = [None], [0]
+    open_nodes = [0] if depth > 1 else []
+    for i in range(1, size):
+        if depth <= 1:
+            parent = None
+        elif shape == 'wide':
+            parent = 0
+        elif shape == 'deep':
+            parent = i - 1 if levels[i - 1] < depth - 1 else 0
+        else:
+            parent = rng.choice(open_nodes)
+        parents.append(parent)
+        levels.append(0 if parent is None else levels[parent] + 1)
+        if levels[i] < depth - 1:
+            open_nodes.append(i)
+    return parents, levels
+
+
+def build_forest(entities=10, threads=10, size=20, depth=5, shape='random', authors=50,
+                 batch_size=1000, seed=None, notify=False):
+    """
+    Создает entities сущностей по threads веток из size комментариев. Комментарии вставляются
+    по уровням пачками через bulk_create_comments, поэтому число запросов не зависит от размера ветки.
+    Возвращает созданные сущности
+    """
+    rng = random.Random(seed)
+    users = mommy.make(get_user_model(), _quantity=authors)
+    posts = mommy.make(BlogPost, _quantity=entities)
+    entity_type = ContentType.objects.get_for_model(BlogPost)
+    comment_type = ContentType.objects.get_for_model(Comment)
+
+    # Уровень -> [(сущность, ветка, индекс в ветке, индекс родителя)]
+    by_level = {}
+    for post in posts:
+        for thread in range(threads):
+            parents, levels = plan_thread(size, depth, shape, rng)
+            for i, (parent, level) in enumerate(zip(parents, levels)):
+                by_level.setdefault(level, []).append((post.id, thread, i, parent))
+
+    created = {}
+    for level in sorted(by_level):
+        nodes = by_level[level]
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start:start + batch_size]
+            comments = []
+            for post_id, thread, i, parent in batch:
+                if parent is None:
+                    parent_type, parent_id = entity_type, post_id
+                else:
+                    parent_type, parent_id = comment_type, created[(post_id, thread, parent)]
+                comments.append(Comment(
+                    author=rng.choice(users),
+                    text=' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))),
+                    parent_type=parent_type,
+                    parent_id=parent_id
+                ))
+            comments = Comment.objects.bulk_create_comments(comments, notify=notify)
+            for (post_id, thread, i, _), comment in zip(batch, comments):
+                created[(post_id, thread, i)] = comment.id
+    return posts
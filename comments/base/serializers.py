@@ -1,4 +1,8 @@
+from collections import defaultdict
+
 from rest_framework import serializers
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from .models import Comment, CommentLog, ALLOWED_CONTENT_TYPES
 
@@ -8,7 +12,9 @@ class CommentListSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
-        fields = ('id', 'created_at', 'text', 'author_id', 'parent_id')
+        fields = (
+            'id', 'created_at', 'text', 'author_id', 'parent_id', 'children_count', 'descendants_count', 'deleted_at'
+        )
 
     def get_parent_id(self, obj):
         if obj.parent_type_id == ContentType.objects.get_for_model(Comment).id:
@@ -16,10 +22,34 @@ class CommentListSerializer(serializers.ModelSerializer):
         return None
 
 
+class CommentDescendantSerializer(CommentListSerializer):
+    depth = serializers.IntegerField(read_only=True)
+
+    class Meta(CommentListSerializer.Meta):
+        fields = CommentListSerializer.Meta.fields + ('depth',)
+
+
+class CommentTreeSerializer(CommentDescendantSerializer):
+    replies = serializers.SerializerMethodField()
+
+    class Meta(CommentDescendantSerializer.Meta):
+        fields = CommentDescendantSerializer.Meta.fields + ('replies',)
+
+    def get_replies(self, obj):
+        return CommentTreeSerializer(obj.replies, many=True, context=self.context).data
+
+
+class CommentSearchSerializer(CommentListSerializer):
+    rank = serializers.IntegerField(read_only=True)
+
+    class Meta(CommentListSerializer.Meta):
+        fields = CommentListSerializer.Meta.fields + ('rank',)
+
+
 class CommentCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
-        fields = ('author', 'text', 'parent_id', 'parent_type')
+        fields = ('id', 'author', 'text', 'parent_id', 'parent_type')
         extra_kwargs = {
             'parent_type': {
                 'queryset': ContentType.objects.filter(model__in=ALLOWED_CONTENT_TYPES)
@@ -35,12 +65,122 @@ class CommentCreateSerializer(serializers.ModelSerializer):
             })
         return data
 
+    def create(self, validated_data):
+        try:
+            return super().create(validated_data)
+        except Comment.DoesNotExist:
+            # Родителя удалили после проверки в validate
+            raise serializers.ValidationError({'parent_id': 'comment does not exist'})
+
+
+class CommentBulkCreateSerializer(serializers.ListSerializer):
+    """Проверяет авторов и родителей всей пачки несколькими запросами вместо запроса на комментарий"""
+
+    def to_internal_value(self, data):
+        if isinstance(data, list) and len(data) > settings.COMMENTS_BULK_MAX_SIZE:
+            raise serializers.ValidationError({
+                'non_field_errors': [f'No more than {settings.COMMENTS_BULK_MAX_SIZE} comments per request']
+            })
+        items = super().to_internal_value(data)
+        errors = [{} for _ in items]
+
+        content_types = ContentType.objects.filter(model__in=ALLOWED_CONTENT_TYPES).in_bulk()
+        parent_ids = defaultdict(set)
+        for item in items:
+            if item['parent_type'] in content_types:
+                parent_ids[item['parent_type']].add(item['parent_id'])
+        existing_parents = {
+            (content_type_id, parent_id)
+            for content_type_id, ids in parent_ids.items()
+            for parent_id in content_types[content_type_id].model_class().objects.filter(
+                id__in=ids).values_list('id', flat=True)
+        }
+        existing_authors = set(get_user_model().objects.filter(
+            id__in={item['author'] for item in items}).values_list('id', flat=True))
+
+        for item, item_errors in zip(items, errors):
+            if item['author'] not in existing_authors:
+                item_errors['author'] = ['user does not exist']
+            if item['parent_type'] not in content_types:
+                item_errors['parent_type'] = ['content type is not allowed']
+            elif (item['parent_type'], item['parent_id']) not in existing_parents:
+                item_errors['parent_id'] = [f'{content_types[item["parent_type"]].model} does not exist']
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def create(self, validated_data):
+        try:
+            return Comment.objects.bulk_create_comments([
+                Comment(
+                    author_id=item['author'],
+                    text=item['text'],
+                    parent_id=item['parent_id'],
+                    parent_type_id=item['parent_type']
+                )
+                for item in validated_data
+            ])
+        except Comment.DoesNotExist:
+            # Родителя удалили после проверки в to_internal_value
+            raise serializers.ValidationError({'non_field_errors': ['parent comment does not exist']})
+
+
+class CommentBulkItemSerializer(serializers.Serializer):
+    author = serializers.IntegerField(min_value=1)
+    text = serializers.CharField()
+    parent_id = serializers.IntegerField(min_value=1)
+    parent_type = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        list_serializer_class = CommentBulkCreateSerializer
+
 
 class CommentUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = ('text',)
 
+    def update(self, instance, validated_data):
+        # Только измененные поля: счетчики в загруженном экземпляре могли устареть, их меняют запросы по дереву
+        instance.text = validated_data.get('text', instance.text)
+        instance.save(update_fields=['text', 'updated_at'])
+        return instance
+
+
+class CommentMoveSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Comment
+        fields = ('parent_id', 'parent_type')
+        extra_kwargs = {
+            'parent_id': {'required': True},
+            'parent_type': {
+                'queryset': ContentType.objects.filter(model__in=ALLOWED_CONTENT_TYPES)
+            }
+        }
+
+    def validate(self, data):
+        content_type = data['parent_type']
+        if not content_type.model_class().objects.filter(id=data['parent_id']).exists():
+            raise serializers.ValidationError({
+                'parent_id': f'{content_type.model} does not exist'
+            })
+        if content_type.model_class() is Comment and self.instance.descendants.filter(id=data['parent_id']).exists():
+            raise serializers.ValidationError({
+                'parent_id': 'comment can not be moved into its own subtree'
+            })
+        return data
+
+    def update(self, instance, validated_data):
+        try:
+            return Comment.objects.move_subtree(
+                instance, (validated_data['parent_id'], validated_data['parent_type'].id)
+            )
+        except ValueError:
+            # Родителя перенесли в поддерево instance после проверки в validate
+            raise serializers.ValidationError({
+                'parent_id': 'comment can not be moved into its own subtree'
+            })
+
 
 class CommentLogSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,73 @@
+"""
+Живые обновления веток (Server-Sent Events). После коммита событие о комментарии публикуется
+в канал Redis его сущности, каждое открытое подключение /comments-stream/ подписано на свой канал.
+Подключения долгие, поэтому gunicorn запускается с gevent воркерами (gunicorn_config.py).
+"""
+import json
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Через сколько мс клиент (EventSource) переподключается после закрытия потока
+RETRY_MS = 1000
+
+
+def get_connection():
+    from django_redis import get_redis_connection
+    return get_redis_connection(settings.COMMENTS_STREAM_CACHE_ALIAS)
+
+
+def get_channel(entity_type_id, entity_id):
+    return f'{settings.COMMENTS_STREAM_CHANNEL_PREFIX}:{entity_type_id}:{entity_id}'
+
+
+def publish(entity_type_id, entity_id, data):
+    try:
+        connection = get_connection()
+    except NotImplementedError:
+        # Кеш не на Redis (локальная разработка): потоков нет
+        return
+    try:
+        connection.publish(get_channel(entity_type_id, entity_id), json.dumps(data, ensure_ascii=False))
+    except Exception:
+        # Комментарий уже сохранен, потеря живого обновления не должна ломать запрос
+        logger.warning('Failed to publish comment event', exc_info=True)
+
+
+def subscribe(entity_type_id, entity_id):
+    """pubsub на канал сущности, NotImplementedError - кеш не на Redis"""
+    pubsub = get_connection().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(get_channel(entity_type_id, entity_id))
+    return pubsub
+
+
+def format_event(event, payload):
+    return f'event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+
+
+def stream_events(pubsub, heartbeat, timeout):
+    """
+    Тело ответа text/event-stream: события канала и комментарий-heartbeat, если событий не было
+    heartbeat секунд (не дает прокси закрыть соединение). Через timeout секунд поток закрывается,
+    клиент переподключается сам, а воркер не держит зависшие соединения
+    """
+    try:
+        yield f'retry: {RETRY_MS}\n\n'
+        now = time.monotonic()
+        deadline = now + timeout
+        last_sent = now
+        while now < deadline:
+            message = pubsub.get_message(timeout=min(heartbeat, deadline - now))
+            now = time.monotonic()
+            if message is not None:
+                data = json.loads(message['data'])
+                yield format_event(data['event'], data['payload'])
+                last_sent = now
+            elif now - last_sent >= heartbeat:
+                yield ': ping\n\n'
+                last_sent = now
+    finally:
+        pubsub.close()
@@ -1,8 +1,98 @@
+from celery import chord
+
 from comments.celery import app
 from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+
+from .backends import get_event_backend
+from .routers import read_from_replica
 
 
 @app.task
 def process_comments_to_file_task(task_id):
+    """
+    Полная выгрузка больше COMMENTS_EXPORT_SHARD_SIZE комментариев делится на диапазоны id,
+    части пишутся параллельно на разных воркерах и склеиваются по порядку в merge_export_parts_task.
+    Комментарии читаются из реплики, сама задача - из default (только что создана и могла не дойти до реплики).
+    Если реплика отстала, следующий запрос выгрузки увидит изменения и обновит файл
+    """
+    CommentsAsFileTask = apps.get_model('base', 'CommentsAsFileTask')
+    task = CommentsAsFileTask.objects.get(id=task_id)
+    with read_from_replica():
+        changes = task.get_changes()
+        bounds = task.get_shard_bounds() if changes == 'full' else []
+        if len(bounds) < 2:
+            task.prepare_file(changes)
+            return
+    task.delete_parts()
+    chord(
+        export_part_task.s(task_id, index, after_id, upto_id)
+        for index, (after_id, upto_id) in enumerate(bounds)
+    )(merge_export_parts_task.s(task_id))
+
+
+@app.task(ignore_result=False)
+def export_part_task(task_id, index, after_id, upto_id=None):
     CommentsAsFileTask = apps.get_model('base', 'CommentsAsFileTask')
-    CommentsAsFileTask.objects.get(id=task_id).prepare_file()
+    task = CommentsAsFileTask.objects.get(id=task_id)
+    with read_from_replica():
+        return task.write_part(index, after_id, upto_id)
+
+
+@app.task
+def merge_export_parts_task(parts, task_id):
+    CommentsAsFileTask = apps.get_model('base', 'CommentsAsFileTask')
+    task = CommentsAsFileTask.objects.filter(id=task_id).first()
+    if task is None:
+        # Выгрузка удалена, пока писались части: удалять их уже некому
+        for part in parts:
+            default_storage.delete(part['name'])
+        return
+    task.merge_parts(parts)
+
+
+@app.task
+def fanout_comment_event_task(entity_type_id, entity_id, data):
+    """Делит подписчиков сущности на диапазоны id и раздает их доставку воркерам"""
+    Subscription = apps.get_model('base', 'Subscription')
+    subscriptions = Subscription.objects.filter(
+        entity_type_id=entity_type_id, entity_id=entity_id
+    ).order_by('id').values_list('id', flat=True)
+    batch_size = settings.COMMENTS_EVENT_BATCH_SIZE
+    after_id = 0
+    while True:
+        remaining = subscriptions.filter(id__gt=after_id)
+        boundary = list(remaining[batch_size - 1:batch_size])
+        upto_id = boundary[0] if boundary else None
+        if upto_id is None and not remaining.exists():
+            break
+        deliver_comment_event_task.delay(entity_type_id, entity_id, data, after_id, upto_id)
+        if upto_id is None:
+            break
+        after_id = upto_id
+
+
+@app.task
+def deliver_comment_event_task(entity_type_id, entity_id, data, after_id, upto_id=None):
+    Subscription = apps.get_model('base', 'Subscription')
+    subscriptions = Subscription.objects.filter(
+        entity_type_id=entity_type_id, entity_id=entity_id, id__gt=after_id
+    ).only('id', 'user_id')
+    if upto_id is not None:
+        subscriptions = subscriptions.filter(id__lte=upto_id)
+    subscriptions = list(subscriptions)
+    if subscriptions:
+        get_event_backend().send_many(subscriptions, data)
+
+
+@app.task
+def flush_comment_logs_task():
+    from .models import CommentLogBuffer
+    CommentLogBuffer.flush()
+
+
+@app.task
+def prune_comment_logs_task():
+    call_command('prune_comment_logs')
@@ -1,18 +1,80 @@
+import gzip
+import hmac
+import re
+from collections import OrderedDict
 from datetime import datetime
 
 from rest_framework import generics
+from rest_framework.permissions import SAFE_METHODS, IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import IntegerField, Value
+from django.http import HttpResponse, FileResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_GET
 
+from . import metrics, streams
+from .cache import CachedListMixin
 from .models import Comment, CommentLog, CommentsAsFileTask
-from .permissions import HasChildrenPermission
+from .pagination import KeysetPagination, SearchPagination
+from .permissions import HasChildrenPermission, NotDeletedPermission, SoftDeletePermission, is_soft_delete
+from .routers import read_from_replica
 from .serializers import (
-    CommentCreateSerializer, CommentListSerializer, CommentUpdateSerializer, CommentLogSerializer
+    CommentCreateSerializer, CommentListSerializer, CommentUpdateSerializer, CommentLogSerializer,
+    CommentDescendantSerializer, CommentTreeSerializer, CommentBulkItemSerializer, CommentSearchSerializer,
+    CommentMoveSerializer
 )
 
 
+re_accepts_gzip = re.compile(r'\bgzip\b')
+re_parent = re.compile(r'^\d+:\d+$')
+
+
+def accepts_gzip(request):
+    return bool(re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+
+class ExportFileResponse(FileResponse):
+    """
+    Отдает файл выгрузки по частям, задача остается для повторных запросов.
+    Сжатый файл отдается с Content-Encoding: gzip, клиентам без поддержки gzip - распакованным на лету
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, task, gzip_allowed=True):
+        source = task.file.open('rb')
+        decompress = task.compressed and not gzip_allowed
+        super().__init__(
+            gzip.GzipFile(fileobj=source, mode='rb') if decompress else source,
+            as_attachment=True,
+            filename=f'comments.{task.file_format}',
+            content_type=task.file_content_type
+        )
+        if decompress:
+            # GzipFile не закрывает переданный ему файл, размер распакованных данных заранее неизвестен
+            self._closable_objects.append(source)
+            del self['Content-Length']
+        else:
+            self['Content-Length'] = task.file.size
+        if task.compressed:
+            if not decompress:
+                self['Content-Encoding'] = 'gzip'
+            patch_vary_headers(self, ('Accept-Encoding',))
+
+
+class ReplicaReadMixin(object):
+    """GET читает из реплики, если клиент недавно ничего не менял (ReplicaPinMiddleware)"""
+
+    def dispatch(self, request, *args, **kwargs):
+        replica = request.method in SAFE_METHODS and not getattr(request, 'db_pinned', False)
+        with read_from_replica(replica):
+            return super().dispatch(request, *args, **kwargs)
+
+
 class ParentFromQueryParamsMixin(object):
     def get_parent(self):
         parent_id = self.request.query_params.get('parent', '')
@@ -22,7 +84,33 @@ class ParentFromQueryParamsMixin(object):
         return None
 
 
-class CommentListView(ParentFromQueryParamsMixin, generics.ListCreateAPIView):
+class FilterFromQueryParamsMixin(object):
+    def get_filter_params(self):
+        return {
+            'author_id': self._normalize_id(self.request.query_params.get('author', '')),
+            'entity_id': self._normalize_id(self.request.query_params.get('entity', '')),
+            'entity_type_id': self._normalize_id(self.request.query_params.get('entity_type', '')),
+            'date_from': self._normalize_date(self.request.query_params.get('date_from')),
+            'date_to': self._normalize_date(self.request.query_params.get('date_to'))
+        }
+
+    @staticmethod
+    def _normalize_date(value):
+        try:
+            return datetime.strptime(value, '%d-%m-%Y')
+        except (ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def _normalize_id(value):
+        if value.isdigit():
+            return int(value)
+        return None
+
+
+class CommentListView(ReplicaReadMixin, ParentFromQueryParamsMixin, CachedListMixin, generics.ListCreateAPIView):
+    pagination_class = KeysetPagination
+
     def get_queryset(self):
         parent = self.get_parent()
         if parent is None:
@@ -35,10 +123,70 @@ class CommentListView(ParentFromQueryParamsMixin, generics.ListCreateAPIView):
         return CommentListSerializer
 
 
+class CommentBatchListView(ReplicaReadMixin, APIView):
+    """Первые страницы ответов сразу для многих родителей (лента): один запрос к базе вместо запроса на родителя"""
+    default_limit = 5
+
+    def get(self, request):
+        parents = self.get_parents()
+        if parents is None:
+            return Response({'error': 'Unexpected query params'}, status=400)
+        limit = self.get_limit()
+        batch = Comment.objects.get_children_batch(parents, limit)
+        return Response([
+            OrderedDict([
+                ('parent_id', parent[0]),
+                ('parent_type', parent[1]),
+                ('count', count),
+                ('next', self.get_next_link(parent, limit, comments) if count > limit else None),
+                ('results', CommentListSerializer(comments, many=True).data)
+            ])
+            for parent, (count, comments) in batch.items()
+        ])
+
+    def get_limit(self):
+        limit = self.request.query_params.get('limit', '')
+        if limit.isdigit() and int(limit) > 0:
+            return min(int(limit), settings.COMMENTS_BATCH_MAX_LIMIT)
+        return self.default_limit
+
+    def get_parents(self):
+        """parents=<parent_id>:<parent_type>,... без повторов, в порядке запроса"""
+        parents = []
+        for pair in self.request.query_params.get('parents', '').split(','):
+            if not re_parent.match(pair):
+                return None
+            parent_id, parent_type_id = map(int, pair.split(':'))
+            if (parent_id, parent_type_id) not in parents:
+                parents.append((parent_id, parent_type_id))
+        if len(parents) > settings.COMMENTS_BATCH_MAX_PARENTS:
+            return None
+        return parents
+
+    def get_next_link(self, parent, limit, comments):
+        # Продолжение ветки - обычный постраничный вывод GET /comments/
+        parent_id, parent_type_id = parent
+        paginator = KeysetPagination()
+        paginator.base_url = self.request.build_absolute_uri(
+            f"{reverse('comment-list')}?parent={parent_id}&parent_type={parent_type_id}&limit={limit}"
+        )
+        return paginator.encode_cursor(paginator.get_position(comments[-1]), reverse=False)
+
+
+class CommentBulkCreateView(generics.CreateAPIView):
+    serializer_class = CommentBulkItemSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        comments = serializer.save()
+        return Response(CommentListSerializer(comments, many=True).data, status=201)
+
+
 class CommentDetailView(generics.DestroyAPIView, generics.UpdateAPIView):
     queryset = Comment.objects
     serializer_class = CommentUpdateSerializer
-    permission_classes = (HasChildrenPermission,)
+    permission_classes = (HasChildrenPermission, SoftDeletePermission, NotDeletedPermission)
 
     def perform_update(self, serializer):
         CommentLog.push(
@@ -50,6 +198,15 @@ class CommentDetailView(generics.DestroyAPIView, generics.UpdateAPIView):
         serializer.save()
 
     def perform_destroy(self, instance):
+        if is_soft_delete(self.request):
+            CommentLog.push(
+                event='TOMBSTONE',
+                user=self.request.user if self.request.user.is_authenticated else None,
+                instance=instance,
+                update={'text': ''}
+            )
+            instance.tombstone()
+            return
         CommentLog.push(
             event='DELETE',
             user=self.request.user if self.request.user.is_authenticated else None,
@@ -58,25 +215,80 @@ class CommentDetailView(generics.DestroyAPIView, generics.UpdateAPIView):
         instance.delete()
 
 
-class CommentDescendantsView(ParentFromQueryParamsMixin, generics.ListAPIView):
-    serializer_class = CommentListSerializer
+class CommentSubtreeView(generics.GenericAPIView):
+    """Удаление комментария со всеми ответами (с soft=1 - надгробиями), доступно модераторам (is_staff)"""
+    queryset = Comment.objects
+    permission_classes = (IsAdminUser,)
+
+    def delete(self, request, *args, **kwargs):
+        instance = self.get_object()
+        soft = request.query_params.get('soft') == '1'
+        with transaction.atomic():
+            comment_ids = Comment.objects.delete_subtree(instance, soft=soft)
+            CommentLog.push_many('TOMBSTONE' if soft else 'DELETE', comment_ids, user=request.user)
+        return Response(status=204)
+
+
+class CommentMoveView(generics.GenericAPIView):
+    """Перенос комментария со всеми ответами к другому родителю, доступен модераторам (is_staff)"""
+    queryset = Comment.objects
+    serializer_class = CommentMoveSerializer
+    permission_classes = (IsAdminUser,)
+
+    def post(self, request, *args, **kwargs):
+        instance = self.get_object()
+        serializer = self.get_serializer(instance, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            CommentLog.push(
+                event='MOVE',
+                user=request.user,
+                instance=instance,
+                update={
+                    'parent_type_id': serializer.validated_data['parent_type'].id,
+                    'parent_id': serializer.validated_data['parent_id']
+                }
+            )
+            comment = serializer.save()
+        return Response(CommentListSerializer(comment).data)
+
+
+class CommentDescendantsView(ReplicaReadMixin, ParentFromQueryParamsMixin, CachedListMixin, generics.ListAPIView):
     pagination_class = None
 
     def get_queryset(self):
         parent = self.get_parent()
         if parent is None:
             return Comment.objects.none()
-        return Comment.objects.get_descendants(parent)
+        thread = Comment.objects.get_thread(parent, max_depth=self.get_max_depth())
+        if self.is_tree():
+            return [c for c in thread if c.depth == 1]
+        return thread
+
+    def get_serializer_class(self):
+        if self.is_tree():
+            return CommentTreeSerializer
+        return CommentDescendantSerializer
+
+    def get_max_depth(self):
+        max_depth = self.request.query_params.get('max_depth', '')
+        if max_depth.isdigit() and int(max_depth) > 0:
+            return int(max_depth)
+        return None
+
+    def is_tree(self):
+        return self.request.query_params.get('tree') == '1'
 
 
-class UserCommentListView(generics.ListAPIView):
+class UserCommentListView(ReplicaReadMixin, generics.ListAPIView):
     serializer_class = CommentListSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Comment.objects.filter(author=self.kwargs['user_id'])
 
 
-class CommentListAsFileView(APIView):
+class CommentListAsFileView(FilterFromQueryParamsMixin, APIView):
     def get(self, request):
         params = self.get_params()
         if params is None:
@@ -86,40 +298,98 @@ class CommentListAsFileView(APIView):
             return Response(status=201)
         if not task.ready:
             return Response(status=208)
+        gzip_allowed = accepts_gzip(request)
+        if settings.COMMENTS_EXPORT_SENDFILE and (gzip_allowed or not task.compressed):
+            return self.get_sendfile_response(task)
+        return ExportFileResponse(task, gzip_allowed)
+
+    def get_sendfile_response(self, task):
+        # Файл отдает nginx, задача удалится, если ее не запрашивали EXPIRE_TIME
         response = HttpResponse(content_type=task.file_content_type)
         response['Content-Disposition'] = f'attachment; filename="comments.{task.file_format}"'
-        response.write(task.file.read())
-        task.delete()
+        if settings.COMMENTS_EXPORT_SENDFILE == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.COMMENTS_EXPORT_ACCEL_PREFIX + task.file.name
+        else:
+            response['X-Sendfile'] = task.file.path
+        if task.compressed:
+            response['Content-Encoding'] = 'gzip'
+            patch_vary_headers(response, ('Accept-Encoding',))
         return response
 
     def get_params(self):
-        params = {
-            'author_id': self._normalize_id(self.request.query_params.get('author', '')),
-            'entity_id': self._normalize_id(self.request.query_params.get('entity', '')),
-            'entity_type_id': self._normalize_id(self.request.query_params.get('entity_type', '')),
-            'date_from': self._normalize_date(self.request.query_params.get('date_from')),
-            'date_to': self._normalize_date(self.request.query_params.get('date_to'))
-        }
+        params = self.get_filter_params()
         if not (params['author_id'] or params['entity_id'] and params['entity_type_id']):
             return None
+        # Не format: этот параметр DRF использует для выбора renderer-а ответа
+        params['file_format'] = self.request.query_params.get('file_format', 'xml')
+        if params['file_format'] not in CommentsAsFileTask.CONTENT_TYPES:
+            return None
         return params
 
-    @staticmethod
-    def _normalize_date(value):
-        try:
-            return datetime.strptime(value, '%d-%m-%Y')
-        except (ValueError, TypeError):
-            return None
 
-    @staticmethod
-    def _normalize_id(value):
-        if value.isdigit():
-            return int(value)
-        return None
+class CommentSearchView(ReplicaReadMixin, FilterFromQueryParamsMixin, generics.ListAPIView):
+    serializer_class = CommentSearchSerializer
+    pagination_class = SearchPagination
+
+    def get_queryset(self):
+        query = self.request.query_params.get('q', '').strip()
+        if not query:
+            # Пустая выборка все равно сортируется по rank в SearchPagination
+            return Comment.objects.none().annotate(rank=Value(0, output_field=IntegerField()))
+        params = self.get_filter_params()
+        return Comment.objects.search(
+            query,
+            author_id=params['author_id'],
+            entity=(params['entity_id'], params['entity_type_id']),
+            date_from=params['date_from'],
+            date_to=params['date_to']
+        )
 
 
-class CommentLogView(generics.ListAPIView):
+class CommentLogView(ReplicaReadMixin, generics.ListAPIView):
     serializer_class = CommentLogSerializer
 
     def get_queryset(self):
         return CommentLog.objects.filter(comment_id=self.kwargs['pk'])
+
+
+def metrics_view(request):
+    """
+    Метрики всех процессов в формате Prometheus. Доступ по токену COMMENTS_METRICS_TOKEN
+    (заголовок Authorization: Bearer) или сотрудникам
+    """
+    token = settings.COMMENTS_METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    has_token = bool(token) and hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+    # Токен проверяется первым: scrape Prometheus не ходит в базу за сессией
+    if not has_token and not request.user.is_staff:
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    try:
+        content = metrics.render()
+    except NotImplementedError:
+        return JsonResponse({'error': 'Metrics are not available'}, status=503)
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@require_GET
+def comment_stream_view(request):
+    """
+    События о комментариях сущности (CREATED, UPDATED, DELETE, BULK_CREATED, BULK_DELETED, MOVED)
+    потоком Server-Sent Events. Без DRF: соединение держится минутами, а аутентификация DRF обращалась бы к базе
+    """
+    entity_id = FilterFromQueryParamsMixin._normalize_id(request.GET.get('entity', ''))
+    entity_type_id = FilterFromQueryParamsMixin._normalize_id(request.GET.get('entity_type', ''))
+    if entity_id is None or entity_type_id is None:
+        return JsonResponse({'error': 'Unexpected query params'}, status=400)
+    try:
+        pubsub = streams.subscribe(entity_type_id, entity_id)
+    except NotImplementedError:
+        return JsonResponse({'error': 'Streaming is not available'}, status=503)
+    response = StreamingHttpResponse(
+        streams.stream_events(pubsub, settings.COMMENTS_STREAM_HEARTBEAT, settings.COMMENTS_STREAM_TIMEOUT),
+        content_type='text/event-stream; charset=utf-8'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # nginx не должен буферизовать поток
+    response['X-Accel-Buffering'] = 'no'
+    return response
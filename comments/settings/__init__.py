@@ -1,5 +1,7 @@
 import os
 
+from .databases import get_databases
+
 # ==============================================================================
 # Django
 # ==============================================================================
@@ -34,6 +36,9 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'comments.base.middleware.MetricsMiddleware',
+    'comments.base.middleware.ProfilingMiddleware',
+    'comments.base.middleware.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -120,6 +125,44 @@ INSTALLED_APPS += (
 
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 
+# Результаты нужны только частям выгрузки (chord), остальные задачи их не сохраняют
+CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+
+CELERY_TASK_IGNORE_RESULT = True
+
+CELERY_RESULT_EXPIRES = 60 * 60
+
+# Запускается отдельным процессом celery beat (сервис celerybeat в docker-compose.yml)
+CELERY_BEAT_SCHEDULE = {
+    'flush-comment-logs': {
+        'task': 'comments.base.tasks.flush_comment_logs_task',
+        'schedule': 5,
+        # При остановленных воркерах не копим в очереди устаревшие запуски
+        'options': {'expires': 5},
+    },
+    'prune-comment-logs': {
+        'task': 'comments.base.tasks.prune_comment_logs_task',
+        'schedule': 60 * 60 * 24,
+    },
+}
+
+
+# ==============================================================================
+# Cache
+# ==============================================================================
+
+# Redis с политикой вытеснения volatile-lru: ключи кеша имеют TTL, очереди celery не вытесняются
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://redis:6379/1'),
+        'KEY_PREFIX': 'comments',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    }
+}
+
 
 # ==============================================================================
 # REST
@@ -134,6 +177,97 @@ REST_FRAMEWORK = {
 }
 
 
+# ==============================================================================
+# Comments
+# ==============================================================================
+
+# Отдача выгрузок средствами веб-сервера: None, 'x-accel-redirect' (nginx) или 'x-sendfile'
+COMMENTS_EXPORT_SENDFILE = os.getenv('COMMENTS_EXPORT_SENDFILE') or None
+
+# internal location nginx, указывающий на MEDIA_ROOT
+COMMENTS_EXPORT_ACCEL_PREFIX = '/protected-media/'
+
+# Хранить выгрузки сжатыми gzip, клиентам с Accept-Encoding: gzip файл отдается как есть
+COMMENTS_EXPORT_GZIP = os.getenv('COMMENTS_EXPORT_GZIP', '0') == '1'
+
+# Полная выгрузка больше COMMENTS_EXPORT_SHARD_SIZE комментариев пишется частями параллельно,
+# частей не больше COMMENTS_EXPORT_MAX_SHARDS
+COMMENTS_EXPORT_SHARD_SIZE = 50000
+
+COMMENTS_EXPORT_MAX_SHARDS = 16
+
+# Доставка событий подписчикам и размер пачки подписчиков на одну задачу celery
+COMMENTS_EVENT_BACKEND = 'comments.base.backends.ConsoleEventBackend'
+
+COMMENTS_EVENT_BATCH_SIZE = 1000
+
+# После записи чтения клиента COMMENTS_DB_PIN_SECONDS секунд идут в default, а не в реплику (cookie)
+COMMENTS_DB_PIN_SECONDS = 10
+
+COMMENTS_DB_PIN_COOKIE = 'comments_db_pin'
+
+# Живые обновления веток (/comments-stream/): каналы Redis кеша COMMENTS_STREAM_CACHE_ALIAS,
+# heartbeat и время жизни одного подключения в секундах
+COMMENTS_STREAM_CACHE_ALIAS = 'default'
+
+COMMENTS_STREAM_CHANNEL_PREFIX = 'comments:events'
+
+COMMENTS_STREAM_HEARTBEAT = 15
+
+COMMENTS_STREAM_TIMEOUT = 5 * 60
+
+# Максимальный размер пачки для POST /comments/bulk/ и import_comments
+COMMENTS_BULK_MAX_SIZE = 1000
+
+# GET /comments/batch/: максимум родителей в запросе и ответов на каждого
+COMMENTS_BATCH_MAX_PARENTS = 50
+COMMENTS_BATCH_MAX_LIMIT = 50
+
+# Кеш списков и деревьев комментариев: TTL страницы, время ожидания пересчета другим процессом,
+# TTL версии сущности (сменой версии страницы сбрасываются при изменениях)
+COMMENTS_CACHE_ALIAS = 'default'
+
+COMMENTS_CACHE_TIMEOUT = int(os.getenv('COMMENTS_CACHE_TIMEOUT', 300))
+
+COMMENTS_CACHE_LOCK_TIMEOUT = 10
+
+COMMENTS_CACHE_VERSION_TIMEOUT = 60 * 60 * 24
+
+# Записи лога изменений копятся в Redis кеша COMMENTS_LOG_CACHE_ALIAS и пишутся в базу пачками
+# задачей celery beat (раз в 5 секунд), срок хранения записей (None - хранить всегда)
+COMMENTS_LOG_ASYNC = True
+
+COMMENTS_LOG_CACHE_ALIAS = 'default'
+
+COMMENTS_LOG_BUFFER_KEY = 'comments:log-buffer'
+
+COMMENTS_LOG_FLUSH_BATCH_SIZE = 1000
+
+COMMENTS_LOG_RETENTION_DAYS = 365
+
+# Метрики Prometheus (/metrics): процессы складывают значения в Redis кеша COMMENTS_METRICS_CACHE_ALIAS
+COMMENTS_METRICS_ENABLED = os.getenv('COMMENTS_METRICS_ENABLED', '1') == '1'
+
+COMMENTS_METRICS_CACHE_ALIAS = 'default'
+
+COMMENTS_METRICS_KEY_PREFIX = 'comments:metrics'
+
+# Токен Prometheus для /metrics (Authorization: Bearer), без него метрики видят только сотрудники
+COMMENTS_METRICS_TOKEN = os.getenv('COMMENTS_METRICS_TOKEN', '')
+
+# Профилирование запросов в лог comments.base: доля запросов под cProfile, порог медленного запроса
+# в секундах (SQL таких запросов пишется всегда), сколько запросов запоминать и строк выводить
+COMMENTS_PROFILE_ENABLED = os.getenv('COMMENTS_PROFILE_ENABLED', '0') == '1'
+
+COMMENTS_PROFILE_SAMPLE_RATE = float(os.getenv('COMMENTS_PROFILE_SAMPLE_RATE', 0.01))
+
+COMMENTS_PROFILE_SLOW_THRESHOLD = float(os.getenv('COMMENTS_PROFILE_SLOW_THRESHOLD', 1.0))
+
+COMMENTS_PROFILE_MAX_QUERIES = 500
+
+COMMENTS_PROFILE_TOP = 20
+
+
 # ==============================================================================
 # Logging
 # ==============================================================================
@@ -171,16 +305,17 @@ LOGGING = {
 # Databases
 # ==============================================================================
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'comments',
-        'USER': os.getenv('POSTGRES_USER', 'postgres'),
-        'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'postgres'),
-        'HOST': os.getenv('POSTGRES_HOST', 'postgres'),
-        'PORT': 5432,
-    }
-}
+# Пул соединений (DATABASE_POOL: '', process, pgbouncer) и время жизни соединений без пула,
+# production.py задает свои значения по умолчанию. Реплики только для чтения: POSTGRES_REPLICA_HOSTS,
+# для проверки на одной базе достаточно указать тот же хост, что у default
+DATABASES = get_databases(
+    pool=os.getenv('DATABASE_POOL', ''),
+    conn_max_age=int(os.getenv('CONN_MAX_AGE', 0))
+)
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+DATABASE_ROUTERS = ['comments.base.routers.ReplicaRouter']
 
 # ==============================================================================
 # Settings imports
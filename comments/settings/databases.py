@@ -0,0 +1,45 @@
+import os
+
+
+def get_databases(pool='', conn_max_age=0):
+    """
+    DATABASES для режима пула соединений:
+    '' - без пула, соединения живут conn_max_age секунд (0 - соединение на запрос или задачу);
+    'process' - пул в процессе (gevent воркеры gunicorn), соединение возвращается в пул после каждого запроса;
+    'pgbouncer' - через pgbouncer в режиме pool_mode=transaction: серверные курсоры отключены,
+    а у postgres должна быть timezone UTC (иначе Django выполняет SET TIME ZONE на каждом соединении).
+    Реплики (POSTGRES_REPLICA_HOSTS=host[:port],...) получают алиасы replica_1, replica_2, ...
+    """
+    default = {
+        'ENGINE': 'comments.base.postgresql',
+        'NAME': 'comments',
+        'USER': os.getenv('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'postgres'),
+        'HOST': os.getenv('POSTGRES_HOST', 'postgres'),
+        'PORT': 5432,
+        'CONN_MAX_AGE': conn_max_age,
+        # Простоявшее дольше соединение проверяется SELECT 1 перед запросом
+        'HEALTH_CHECK_INTERVAL': 30,
+    }
+    if pool == 'process':
+        default.update(CONN_MAX_AGE=0, POOL={
+            'MAX_SIZE': int(os.getenv('DATABASE_POOL_SIZE', 20)),
+            'TIMEOUT': 10,
+            'MAX_IDLE': 300,
+        })
+    elif pool == 'pgbouncer':
+        default.update(
+            HOST=os.getenv('PGBOUNCER_HOST', 'pgbouncer'),
+            PORT=int(os.getenv('PGBOUNCER_PORT', 6432)),
+            DISABLE_SERVER_SIDE_CURSORS=True,
+        )
+    elif pool:
+        raise ValueError(f'Unknown database pool {pool!r}')
+
+    databases = {'default': default}
+    for number, address in enumerate(filter(None, os.getenv('POSTGRES_REPLICA_HOSTS', '').split(',')), 1):
+        host, _, port = address.strip().partition(':')
+        databases[f'replica_{number}'] = dict(
+            default, HOST=host, PORT=int(port or 5432), TEST={'MIRROR': 'default'}
+        )
+    return databases
@@ -1,5 +1,14 @@
+import os
+
 from . import *  # NOQA
+from .databases import get_databases
 
 DEBUG = False
 
 COMPRESS_ENABLED = not DEBUG
+
+# Соединения из пула процесса переиспользуются запросами gunicorn (gevent) и задачами celery
+DATABASES = get_databases(
+    pool=os.getenv('DATABASE_POOL', 'process'),
+    conn_max_age=int(os.getenv('CONN_MAX_AGE', 300))
+)
@@ -2,8 +2,11 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from django.conf import settings
 
+from comments.base.views import metrics_view
+
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^metrics$', metrics_view),
     url(r'^', include('comments.base.api_urls'))
 ]
 
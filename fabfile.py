@@ -67,3 +67,9 @@ def manage(command):
 @task
 def runtests(app=''):
     local('docker-compose exec django python manage.py test %s --keepdb' % app)
+
+
+@task
+def loadtest(mix='mixed', duration='60', concurrency='16'):
+    local('docker-compose exec django python manage.py loadtest --url http://localhost:8000 '
+          '--mix %s --duration %s --concurrency %s' % (mix, duration, concurrency))
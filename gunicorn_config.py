@@ -4,3 +4,13 @@ raw_env = ['='.join([key, value]) for key, value in os.environ.items()]
 bind = '0.0.0.0:8000'
 max_requests = 1000
 workers = 4
+# gevent: долгие подключения /comments-stream/ не занимают по воркеру каждое
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = 1000
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # Иначе запросы psycopg2 блокируют все greenlet-ы воркера
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()